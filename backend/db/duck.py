@@ -1,15 +1,24 @@
 """
 DuckDB multi-file manager.
 Each uploaded CSV gets its own file_id (UUID). All state is keyed by file_id.
-Data is persisted on disk (CSV + metadata) and auto-restored on server start.
+Every file lives in its own schema ("f_<file_id>") of one shared in-memory
+database; cursors set search_path so SQL just says "uploaded".
+Data is persisted on disk (Parquet + metadata) and auto-restored on server start.
 """
+import asyncio
 import duckdb
-import pandas as pd
+import hashlib
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
 import math
-import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 from datetime import datetime, timezone
+from backend.db import sql_guard
 
 # ---------------------------------------------------------------------------
 # Paths
@@ -20,25 +29,110 @@ META_PATH  = DATA_DIR / "files.json"
 DATA_DIR.mkdir(exist_ok=True)
 
 # ---------------------------------------------------------------------------
-# In-memory registry: file_id → { conn, schema, json_data }
+# Shared database + in-memory registry: file_id → { schema, counts[, sample] }
 # ---------------------------------------------------------------------------
+_CONN = duckdb.connect(database=":memory:")
+# Queries run on worker threads (asyncio.to_thread); let each use every core
+DUCKDB_THREADS = os.cpu_count() or 4
+_CONN.execute(f"PRAGMA threads={DUCKDB_THREADS}")
+
 _registry: dict[str, dict] = {}
+_registry_lock = threading.Lock()
+
+
+def _schema_name(file_id: str) -> str:
+    return f"f_{file_id}"
+
+
+def cursor(file_id: str) -> duckdb.DuckDBPyConnection:
+    """
+    New cursor on the shared database scoped to file_id: "uploaded" resolves
+    to that file's table. Cursors are independent connections, so each
+    caller (and thread) gets its own; use as a context manager to close it.
+    """
+    cur = _CONN.cursor()
+    cur.execute(f"SET search_path = '{_schema_name(file_id)}'")
+    return cur
 
 
 # ---------------------------------------------------------------------------
 # Metadata helpers (persisted to files.json)
 # ---------------------------------------------------------------------------
+# files.json is parsed only when its mtime changes; otherwise this dict is
+# the source of truth and writes are coalesced so a burst of uploads/deletes
+# costs one disk write.
+_meta: Optional[dict] = None
+_meta_mtime: Optional[float] = None
+_meta_dirty = False
+_flush_handle: Optional[asyncio.TimerHandle] = None
+META_FLUSH_DELAY = 0.5
+
+# Sorted list_files() result; reset whenever metadata or the registry changes
+_files_cache: Optional[list[dict]] = None
+_files_by_id: dict[str, dict] = {}  # rebuilt together with _files_cache
+# Bumped on every reset; with the per-process id it makes the /files ETag
+_files_version = 0
+_BOOT_ID = os.urandom(4).hex()
+
+
+def _invalidate_files():
+    global _files_cache, _files_version
+    _files_cache = None
+    _files_version += 1
+
+
+def _mtime(path: Path) -> Optional[float]:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
 def _load_meta() -> dict:
-    if META_PATH.exists():
-        try:
-            return json.loads(META_PATH.read_text())
-        except Exception:
-            pass
-    return {}
+    global _meta, _meta_mtime
+    # Re-read if never loaded, or if someone else changed the file while we
+    # have nothing pending for it
+    mtime = _mtime(META_PATH)
+    if _meta is None or (not _meta_dirty and mtime != _meta_mtime):
+        _meta = {}
+        if mtime is not None:
+            try:
+                _meta = orjson.loads(META_PATH.read_bytes())
+            except Exception:
+                pass
+        _meta_mtime = mtime
+        _invalidate_files()
+    return _meta
 
 
 def _save_meta(meta: dict):
-    META_PATH.write_text(json.dumps(meta, indent=2))
+    """Mark metadata dirty and schedule a write META_FLUSH_DELAY from now."""
+    global _meta, _meta_dirty, _flush_handle
+    _meta = meta
+    _meta_dirty = True
+    _invalidate_files()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush_meta()  # no event loop (startup, scripts, worker threads)
+        return
+    if _flush_handle is None:
+        _flush_handle = loop.call_later(META_FLUSH_DELAY, flush_meta)
+
+
+def flush_meta():
+    """Write pending metadata now (atomic replace, so readers never see a torn file)."""
+    global _meta_dirty, _meta_mtime, _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _meta_dirty or _meta is None:
+        return
+    tmp = META_PATH.with_suffix(".json.tmp")
+    tmp.write_bytes(orjson.dumps(_meta, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, META_PATH)
+    _meta_mtime = _mtime(META_PATH)
+    _meta_dirty = False
 
 
 def _sanitize(val):
@@ -47,39 +141,168 @@ def _sanitize(val):
     return val
 
 
+def _json_safe(col: pa.ChunkedArray) -> pa.ChunkedArray:
+    """NaN/inf → null, DECIMAL/HUGEINT → float, temporal → ISO string."""
+    if pa.types.is_floating(col.type):
+        return pc.if_else(pc.is_finite(col), col, pa.scalar(None, col.type))
+    if pa.types.is_decimal(col.type):
+        return pc.cast(col, pa.float64())
+    if pa.types.is_temporal(col.type):
+        return pc.cast(col, pa.string())
+    return col
+
+
+def arrow_to_rows(tbl: pa.Table) -> list[dict]:
+    """Make an Arrow result JSON-safe column by column, then emit row dicts."""
+    for i, name in enumerate(tbl.column_names):
+        col = _json_safe(tbl.column(i))
+        if col is not tbl.column(i):
+            tbl = tbl.set_column(i, pa.field(name, col.type), col)
+    return tbl.to_pylist()
+
+
 # ---------------------------------------------------------------------------
 # Startup restore
 # ---------------------------------------------------------------------------
+def _restore_one(item: tuple[str, dict]):
+    file_id, info = item
+    if file_id in _registry:
+        return
+    parquet_path = _parquet_path(file_id)
+    csv_path = DATA_DIR / f"{file_id}.csv"
+    try:
+        if parquet_path.exists():
+            _load_parquet(file_id, parquet_path, info["filename"])
+        elif csv_path.exists():
+            # Uploads saved before the switch to Parquet: convert once.
+            _load_csv(file_id, csv_path, info["filename"])
+            with cursor(file_id) as cur:
+                cur.execute(
+                    f"COPY \"uploaded\" TO '{_sql_str(parquet_path)}' (FORMAT parquet, COMPRESSION zstd)"
+                )
+            csv_path.unlink()
+        else:
+            return
+        print(f"✅ Restored [{info['filename']}] id={file_id[:8]}…")
+    except Exception as e:
+        print(f"⚠️  Could not restore {file_id}: {e}")
+
+
 def restore_all():
-    """On server start, reload every saved CSV back into memory."""
+    """
+    On server start, reload every saved upload back into memory.
+    Files are independent and DuckDB releases the GIL while
+    loading, so they are restored in parallel.
+    """
     meta = _load_meta()
-    for file_id, info in meta.items():
-        csv_path = DATA_DIR / f"{file_id}.csv"
-        if csv_path.exists() and file_id not in _registry:
-            try:
-                df = pd.read_csv(csv_path)
-                df.columns = [c.strip().replace(" ", "_").lower() for c in df.columns]
-                _load_df(file_id, df, info["filename"])
-                print(f"✅ Restored [{info['filename']}] id={file_id[:8]}…")
-            except Exception as e:
-                print(f"⚠️  Could not restore {file_id}: {e}")
+    if not meta:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(meta), os.cpu_count() or 1)) as ex:
+        list(ex.map(_restore_one, meta.items()))
 
 
 # ---------------------------------------------------------------------------
 # Core loading
 # ---------------------------------------------------------------------------
-def _load_df(file_id: str, df: pd.DataFrame, filename: str) -> dict:
-    """Register DataFrame into a fresh in-memory DuckDB for this file_id."""
-    conn = duckdb.connect(database=":memory:")
-    conn.execute('CREATE TABLE "uploaded" AS SELECT * FROM df')
-
-    cols_info = conn.execute(
-        "SELECT column_name, data_type FROM information_schema.columns "
-        "WHERE table_name = 'uploaded' ORDER BY ordinal_position"
-    ).fetchall()
-
-    row_count = int(conn.execute('SELECT COUNT(*) FROM "uploaded"').fetchone()[0])
-    sample = conn.execute('SELECT * FROM "uploaded" LIMIT 15').df().to_dict(orient="records")
+# What pandas.read_csv would infer. Left to itself DuckDB's sniffer turns
+# Yes/No columns into BOOLEAN and dates into DATE, which the prompts and the
+# stats route don't expect.
+CSV_TYPE_CANDIDATES = ["BIGINT", "DOUBLE", "VARCHAR"]
+
+
+def _parquet_path(file_id: str) -> Path:
+    return DATA_DIR / f"{file_id}.parquet"
+
+
+def _sql_str(value) -> str:
+    return str(value).replace("'", "''")
+
+
+def _normalize_column_names(conn: duckdb.DuckDBPyConnection):
+    """Clean column names (strip, spaces → _, lowercase) via ALTER TABLE."""
+    for name, *_ in conn.execute('DESCRIBE "uploaded"').fetchall():
+        clean = name.strip().replace(" ", "_").lower()
+        if clean != name:
+            conn.execute(
+                'ALTER TABLE "uploaded" RENAME COLUMN "{}" TO "{}"'.format(
+                    name.replace('"', '""'), clean.replace('"', '""')
+                )
+            )
+
+
+COUNTS_CACHE_MAX = 1000
+SAMPLE_ROWS = 15
+ENUM_MAX_DISTINCT = 256
+
+
+def _counts_sql(col: str, limit: Optional[int] = None) -> str:
+    sql = (
+        f'SELECT CAST("{col}" AS VARCHAR) AS k, COUNT(*) AS c FROM "uploaded" '
+        f'GROUP BY 1 ORDER BY c DESC, k'
+    )
+    return sql + (f" LIMIT {limit}" if limit else "")
+
+
+def _counts_pair(rows: list[tuple]) -> tuple[list, list]:
+    """GROUP BY rows → (labels, values), already in display order."""
+    labels = ["null" if k is None else k for k, _ in rows]
+    values = [c for _, c in rows]
+    return labels, values
+
+
+def _create_schema(file_id: str) -> duckdb.DuckDBPyConnection:
+    """(Re)create file_id's schema and return a cursor scoped to it."""
+    name = _schema_name(file_id)
+    with _CONN.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{name}" CASCADE')
+        cur.execute(f'CREATE SCHEMA "{name}"')
+    return cursor(file_id)
+
+
+def _encode_low_cardinality(conn: duckdb.DuckDBPyConnection):
+    """
+    Dictionary-encode categorical text columns as ENUMs: fewer than
+    ENUM_MAX_DISTINCT values and none of them numeric (numbers stored as
+    text must stay VARCHAR so TRY_CAST keeps working on them).
+    """
+    for name, ctype, *_ in conn.execute('DESCRIBE "uploaded"').fetchall():
+        if ctype != "VARCHAR":
+            continue
+        q = name.replace('"', '""')
+        distinct, numeric = conn.execute(
+            f'SELECT COUNT(DISTINCT "{q}"), COUNT(TRY_CAST("{q}" AS DOUBLE)) FROM "uploaded"'
+        ).fetchone()
+        if 0 < distinct < ENUM_MAX_DISTINCT and numeric == 0:
+            conn.execute(
+                f'CREATE TYPE "enum_{q}" AS ENUM '
+                f'(SELECT DISTINCT "{q}" FROM "uploaded" WHERE "{q}" IS NOT NULL ORDER BY 1)'
+            )
+            conn.execute(f'ALTER TABLE "uploaded" ALTER COLUMN "{q}" TYPE "enum_{q}"')
+
+
+def _register(file_id: str, filename: str) -> dict:
+    """Build the schema for file_id's "uploaded" table and add it to the registry."""
+    with cursor(file_id) as conn:
+        _encode_low_cardinality(conn)
+        # Report ENUM('a', 'b', …) columns simply as ENUM
+        cols_info = [
+            (name, "ENUM" if ctype.startswith("ENUM(") else ctype)
+            for name, ctype, *_ in conn.execute('DESCRIBE "uploaded"').fetchall()
+        ]
+
+        row_count = int(conn.execute('SELECT COUNT(*) FROM "uploaded"').fetchone()[0])
+
+    # Value counts for text columns are precomputed (data is immutable per
+    # file_id); columns with more than COUNTS_CACHE_MAX distinct values are
+    # left to get_column_counts' query.
+    counts = {}
+    with cursor(file_id) as conn:
+        for name, ctype in cols_info:
+            if ctype not in ("VARCHAR", "ENUM"):
+                continue
+            rows = conn.execute(_counts_sql(name, COUNTS_CACHE_MAX + 1)).fetchall()
+            if len(rows) <= COUNTS_CACHE_MAX:
+                counts[name] = _counts_pair(rows)
 
     schema = {
         "file_id":    file_id,
@@ -87,33 +310,85 @@ def _load_df(file_id: str, df: pd.DataFrame, filename: str) -> dict:
         "table_name": "uploaded",
         "row_count":  row_count,
         "columns":    [{"name": c[0], "type": c[1]} for c in cols_info],
-        "sample":     sample,
     }
 
-    raw = conn.execute('SELECT * FROM "uploaded"').df()
-    json_data = [
-        {k: _sanitize(v) for k, v in row.items()}
-        for row in raw.to_dict(orient="records")
-    ]
+    # Derived once here rather than on every request that needs them
+    cols = tuple(c[0] for c in cols_info)
+    # Every upload gets a fresh file_id, so this also identifies the sample rows
+    fingerprint = hashlib.sha1(
+        orjson.dumps([file_id, schema["table_name"], schema["columns"], row_count])
+    ).hexdigest()
+
+    # Rows stay in DuckDB; JSON is produced per request from the slice asked for.
+    with _registry_lock:
+        _registry[file_id] = {
+            "schema": schema,
+            "cols": cols,
+            "column_set": frozenset(cols),
+            "fingerprint": fingerprint,
+            "counts": counts,
+        }
+        _invalidate_files()  # "loaded" flags changed
+    return schema
+
 
-    _registry[file_id] = {
-        "conn":      conn,
-        "schema":    schema,
-        "json_data": json_data,
-    }
+def _load_csv(file_id: str, path: Path, filename: str) -> dict:
+    """
+    Parse a CSV with DuckDB's own reader, without a pandas hop. Types are
+    sniffed over every row (sample_size=-1), as pandas does.
+    """
+    with _create_schema(file_id) as conn:
+        conn.execute(
+            'CREATE TABLE "uploaded" AS SELECT * FROM '
+            "read_csv_auto(?, header=true, sample_size=-1, auto_type_candidates=?)",
+            [str(path), CSV_TYPE_CANDIDATES],
+        )
+        _normalize_column_names(conn)
+    return _register(file_id, filename)
+
+
+def _load_parquet(file_id: str, path: Path, filename: str) -> dict:
+    """Load a persisted upload straight into DuckDB, without a pandas hop."""
+    with _create_schema(file_id) as conn:
+        conn.execute(
+            'CREATE TABLE "uploaded" AS SELECT * FROM read_parquet(?)', [str(path)]
+        )
+    return _register(file_id, filename)
+
+
+def register_csv_path(path: str, file_id: str, filename: str) -> dict:
+    """
+    Register a new CSV upload straight from a file on disk: DuckDB parses it
+    (multi-threaded, no DataFrame in between) and writes the Parquet copy.
+    Blocking, so it is meant for a worker thread; the caller then adds the
+    file to files.json with record_upload on the event loop.
+    """
+    try:
+        schema = _load_csv(file_id, Path(path), filename)
+        with cursor(file_id) as cur:
+            cur.execute(
+                f"COPY \"uploaded\" TO '{_sql_str(_parquet_path(file_id))}' (FORMAT parquet, COMPRESSION zstd)"
+            )
+    except Exception:
+        _discard(file_id)
+        raise
     return schema
 
 
-def register_dataframe(df: pd.DataFrame, file_id: str, filename: str) -> dict:
-    """Register a new CSV upload. Persists CSV + updates metadata."""
-    df.columns = [c.strip().replace(" ", "_").lower() for c in df.columns]
-    schema = _load_df(file_id, df, filename)
+def _discard(file_id: str):
+    """Undo a failed registration: registry entry, schema and partial Parquet."""
+    with _registry_lock:
+        _registry.pop(file_id, None)
+    with _CONN.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{_schema_name(file_id)}" CASCADE')
+    _parquet_path(file_id).unlink(missing_ok=True)
 
-    # Persist CSV
-    csv_path = DATA_DIR / f"{file_id}.csv"
-    df.to_csv(csv_path, index=False)
 
-    # Update metadata
+def record_upload(file_id: str, filename: str, schema: dict):
+    """
+    Add a freshly registered upload to files.json. Metadata state belongs to
+    the event loop (writes are batched there), so call this from it.
+    """
     meta = _load_meta()
     meta[file_id] = {
         "filename":   filename,
@@ -123,59 +398,120 @@ def register_dataframe(df: pd.DataFrame, file_id: str, filename: str) -> dict:
     }
     _save_meta(meta)
 
-    return schema
-
 
 # ---------------------------------------------------------------------------
 # Accessors
 # ---------------------------------------------------------------------------
 def get_schema(file_id: str) -> Optional[dict]:
-    if file_id in _registry:
-        return _registry[file_id]["schema"]
-    return None
+    entry = _registry.get(file_id)
+    return entry["schema"] if entry is not None else None
 
 
-def get_json_data(file_id: str) -> Optional[list[dict]]:
-    if file_id in _registry:
-        return _registry[file_id]["json_data"]
-    return None
+def get_schema_cols(file_id: str) -> tuple[str, ...]:
+    """Column names of file_id's table, in order (empty if not loaded)."""
+    entry = _registry.get(file_id)
+    return entry["cols"] if entry is not None else ()
 
 
-def get_column_values(file_id: str, column: str) -> list:
-    data = get_json_data(file_id)
-    if not data:
-        return []
-    return [row.get(column) for row in data]
+def get_schema_fingerprint(file_id: str) -> Optional[str]:
+    """Stable hash of file_id's table: the prompt builders cache on it."""
+    entry = _registry.get(file_id)
+    return entry["fingerprint"] if entry is not None else None
+
+
+def has_column(file_id: str, column: str) -> bool:
+    entry = _registry.get(file_id)
+    return entry is not None and column in entry["column_set"]
+
+
+def get_json_data(file_id: str, limit: Optional[int] = None, offset: int = 0) -> Optional[list[dict]]:
+    """Return a LIMIT/OFFSET slice of the dataset as JSON-safe row dicts."""
+    if file_id not in _registry:
+        return None
+    return [row for batch in iter_json_data(file_id, limit, offset) for row in batch]
+
+
+def iter_json_data(file_id: str, limit: Optional[int] = None, offset: int = 0, batch_size: int = 1000):
+    """Same slice as get_json_data, yielded in batches so callers can stream it."""
+    sql = 'SELECT * FROM "uploaded"'
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    if offset:
+        sql += f" OFFSET {int(offset)}"
+    with cursor(file_id) as conn:
+        conn.execute(sql)
+        names = [d[0] for d in conn.description]
+        while True:
+            rows = conn.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [{k: _sanitize(v) for k, v in zip(names, row)} for row in rows]
+
+
+def get_sample(file_id: str, n: int = SAMPLE_ROWS) -> Optional[list[dict]]:
+    """First n rows, fetched on first use and kept for the prompt builders."""
+    entry = _registry.get(file_id)
+    if entry is None:
+        return None
+    sample = entry.get("sample")
+    if sample is None or len(sample) < min(n, entry["schema"]["row_count"]):
+        sample = get_json_data(file_id, limit=max(n, SAMPLE_ROWS))
+        entry["sample"] = sample
+    return sample[:n]
+
+
+def _check_column(file_id: str, column: str) -> str:
+    """Only names from the stored schema may be spliced into SQL as identifiers."""
+    if column not in _registry[file_id]["column_set"]:
+        raise ValueError(f"Column '{column}' not found.")
+    return column
 
 
-def get_column_counts(file_id: str, column: str) -> dict:
-    vals = get_column_values(file_id, column)
-    counts: dict = {}
-    for v in vals:
-        key = str(v) if v is not None else "null"
-        counts[key] = counts.get(key, 0) + 1
-    return dict(sorted(counts.items(), key=lambda x: -x[1]))
+def get_column_values(file_id: str, column: str) -> list:
+    if file_id not in _registry:
+        return []
+    col = _check_column(file_id, column)
+    with cursor(file_id) as conn:
+        tbl = conn.execute(f'SELECT "{col}" FROM "uploaded"').to_arrow_table()
+    return _json_safe(tbl.column(0)).to_pylist()
 
 
-def execute_query(sql: str, file_id: str) -> tuple[list[dict], list[str]]:
+def get_column_counts(file_id: str, column: str) -> tuple[list, list]:
+    """(labels, values) for one column, most frequent first."""
+    if file_id not in _registry:
+        return [], []
+    cached = _registry[file_id]["counts"].get(column)
+    if cached is not None:
+        return cached
+    col = _check_column(file_id, column)
+    with cursor(file_id) as conn:
+        rows = conn.execute(_counts_sql(col)).fetchall()
+    return _counts_pair(rows)
+
+
+def execute_query(sql: str, file_id: str, limit: Optional[int] = None) -> pa.Table:
+    """
+    Run sql against file_id's table and return the Arrow result, capped at
+    limit rows inside DuckDB (see sql_guard.validate_select). Callers convert
+    only the rows they send (arrow_to_rows on a slice), so big results never
+    become Python objects.
+    """
     if file_id not in _registry:
         raise ValueError(f"No dataset loaded for file_id '{file_id}'.")
-    conn = _registry[file_id]["conn"]
-    result = conn.execute(sql).df()
-    rows = [
-        {k: _sanitize(v) for k, v in row.items()}
-        for row in result.to_dict(orient="records")
-    ]
-    return rows, list(result.columns)
+    sql = sql_guard.validate_select(sql, limit)
+    with cursor(file_id) as conn:
+        return conn.execute(sql).to_arrow_table()
 
 
 def delete_file(file_id: str):
-    """Remove file from registry, disk CSV, and metadata."""
+    """Remove file from registry, its DuckDB schema, disk copy, and metadata."""
     _registry.pop(file_id, None)
+    with _CONN.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{_schema_name(file_id)}" CASCADE')
 
-    csv_path = DATA_DIR / f"{file_id}.csv"
-    if csv_path.exists():
-        csv_path.unlink()
+    for path in (_parquet_path(file_id), DATA_DIR / f"{file_id}.csv"):
+        if path.exists():
+            path.unlink()
 
     meta = _load_meta()
     meta.pop(file_id, None)
@@ -183,8 +519,11 @@ def delete_file(file_id: str):
 
 
 def list_files() -> list[dict]:
-    """Return metadata for all known files."""
+    """Return metadata for all known files (cached until metadata changes)."""
+    global _files_cache, _files_by_id
     meta = _load_meta()
+    if _files_cache is not None:
+        return _files_cache
     result = []
     for file_id, info in meta.items():
         result.append({
@@ -197,4 +536,18 @@ def list_files() -> list[dict]:
         })
     # newest first
     result.sort(key=lambda x: x["uploaded_at"], reverse=True)
+    _files_cache = result
+    _files_by_id = {f["file_id"]: f for f in result}
     return result
+
+
+def files_etag() -> str:
+    """Weak ETag for the current list_files() result."""
+    _load_meta()  # picks up (and invalidates on) external edits to files.json
+    return f'W/"{_BOOT_ID}-{_files_version}"'
+
+
+def get_file(file_id: str) -> Optional[dict]:
+    """O(1) lookup of one list_files() entry."""
+    list_files()
+    return _files_by_id.get(file_id)
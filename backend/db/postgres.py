@@ -2,9 +2,10 @@
 PostgreSQL async connection manager using asyncpg.
 Manages the connection pool and exposes helpers for schema/query operations.
 """
+import asyncio
 import asyncpg
 import pandas as pd
-import json
+import time
 from typing import Optional
 
 # ── Connection pool singleton ─────────────────────────────────────────────────
@@ -16,6 +17,10 @@ PG_DSN = "postgresql://localhost:5432/datachat"
 # Tracks tables created this session
 _pg_tables: list[str] = []
 
+# table_name → (fetched_at, schema); avoids an information_schema round-trip per call
+_schema_cache: dict[str, tuple[float, dict]] = {}
+SCHEMA_TTL = 60.0
+
 
 async def get_pool() -> asyncpg.Pool:
     global _pool
@@ -38,11 +43,21 @@ async def load_dataframe(df: pd.DataFrame, table_name: str) -> dict:
     pool = await get_pool()
 
     # Sanitise column names
-    df.columns = [c.strip().replace(" ", "_").lower() for c in df.columns]
+    df.columns = df.columns.str.strip().str.replace(" ", "_", regex=False).str.lower()
+
+    # Whole-number float columns (ints that pandas widened because of gaps)
+    # become nullable Int64, so they load as BIGINT rather than DOUBLE; values
+    # beyond 2**53 aren't exact ints anyway (and may overflow int64)
+    for c in df.columns:
+        col = df[c]
+        if col.dtype.kind == "f":
+            present = col.dropna()
+            if len(present) and present.abs().max() < 2**53 and (present % 1 == 0).all():
+                df[c] = col.astype("Int64")
 
     # Map pandas dtypes → PostgreSQL types
     def pg_type(dtype) -> str:
-        s = str(dtype)
+        s = str(dtype).lower()
         if "int" in s:  return "BIGINT"
         if "float" in s: return "DOUBLE PRECISION"
         return "TEXT"
@@ -53,11 +68,10 @@ async def load_dataframe(df: pd.DataFrame, table_name: str) -> dict:
         await conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
         await conn.execute(f'CREATE TABLE "{table_name}" ({col_defs})')
 
-        # Bulk insert using copy
-        rows = [tuple(
-            None if pd.isna(v) else (int(v) if isinstance(v, float) and v.is_integer() else v)
-            for v in row
-        ) for row in df.itertuples(index=False, name=None)]
+        # Bulk insert using copy. NaN → None is done once for the whole frame;
+        # object dtype hands asyncpg plain Python ints/floats/strs.
+        clean = df.astype(object).where(df.notna(), None)
+        rows = list(clean.itertuples(index=False, name=None))
 
         await conn.copy_records_to_table(
             table_name,
@@ -66,6 +80,7 @@ async def load_dataframe(df: pd.DataFrame, table_name: str) -> dict:
         )
 
     row_count = int(df.shape[0])
+    _schema_cache.pop(table_name, None)
     if table_name not in _pg_tables:
         _pg_tables.append(table_name)
 
@@ -93,7 +108,11 @@ async def list_tables() -> list[dict]:
 
 
 async def get_table_schema(table_name: str) -> dict:
-    """Return column info and sample rows for a PG table."""
+    """Return column info and sample rows for a PG table (cached for SCHEMA_TTL seconds)."""
+    cached = _schema_cache.get(table_name)
+    if cached and time.monotonic() - cached[0] < SCHEMA_TTL:
+        return cached[1]
+
     pool = await get_pool()
     async with pool.acquire() as conn:
         cols = await conn.fetch(
@@ -108,12 +127,14 @@ async def get_table_schema(table_name: str) -> dict:
         count_row = await conn.fetchrow(f'SELECT COUNT(*) FROM "{table_name}"')
         sample = await conn.fetch(f'SELECT * FROM "{table_name}" LIMIT 5')
 
-    return {
+    schema = {
         "table_name": table_name,
         "row_count": count_row[0],
         "columns": [{"name": r["column_name"], "type": r["data_type"]} for r in cols],
         "sample": [dict(r) for r in sample],
     }
+    _schema_cache[table_name] = (time.monotonic(), schema)
+    return schema
 
 
 async def execute_query(sql: str) -> tuple[list[dict], list[str]]:
@@ -136,22 +157,34 @@ async def get_pg_stats(table_name: str) -> dict:
     numeric_cols = [c["name"] for c in schema["columns"] if c["type"].lower() in numeric_types]
     text_cols = [c["name"] for c in schema["columns"] if c["type"].lower() in {"text", "character varying", "varchar"}]
 
+    def _round(v):
+        return round(float(v), 2) if v is not None else None
+
+    # One scan for every numeric column instead of a round-trip per column
     numeric_stats = {}
-    async with (await get_pool()).acquire() as conn:
-        for col in numeric_cols[:5]:
-            row = await conn.fetchrow(f'SELECT MIN("{col}"), MAX("{col}"), AVG("{col}") FROM "{table_name}"')
+    numeric_cols = numeric_cols[:5]
+    if numeric_cols:
+        select_list = ", ".join(
+            f'MIN("{c}"), MAX("{c}"), AVG("{c}")' for c in numeric_cols
+        )
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(f'SELECT {select_list} FROM "{table_name}"')
+        for i, col in enumerate(numeric_cols):
             numeric_stats[col] = {
-                "min": round(float(row[0]), 2) if row[0] else None,
-                "max": round(float(row[1]), 2) if row[1] else None,
-                "avg": round(float(row[2]), 2) if row[2] else None,
+                "min": _round(row[3 * i]),
+                "max": _round(row[3 * i + 1]),
+                "avg": _round(row[3 * i + 2]),
             }
 
-        cat_stats = {}
-        for col in text_cols[:3]:
+    # Top values per text column, each on its own pooled connection
+    async def _top_values(col: str):
+        async with pool.acquire() as conn:
             rows = await conn.fetch(
                 f'SELECT "{col}", COUNT(*) AS cnt FROM "{table_name}" GROUP BY "{col}" ORDER BY cnt DESC LIMIT 5'
             )
-            cat_stats[col] = [{"value": r[col], "count": r["cnt"]} for r in rows]
+        return col, [{"value": r[col], "count": r["cnt"]} for r in rows]
+
+    cat_stats = dict(await asyncio.gather(*(_top_values(c) for c in text_cols[:3])))
 
     return {
         **schema,
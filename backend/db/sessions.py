@@ -0,0 +1,187 @@
+"""
+Chat session store: SQLite (WAL mode) through aiosqlite.
+One row per session plus an append-only messages table (one row per
+message), so a /query turn inserts its new messages instead of rewriting
+the conversation.
+"""
+import aiosqlite
+import orjson
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+DB_PATH = DATA_DIR / "sessions.db"
+LEGACY_JSON = DATA_DIR / "sessions.json"  # pre-SQLite store, imported once
+
+# What the prompts see of a chat: the last HISTORY_MAX_MESSAGES messages, each
+# cut to HISTORY_MAX_CHARS; kept on the session row, so a /query turn never
+# loads the conversation itself
+HISTORY_MAX_MESSAGES = 20
+HISTORY_MAX_CHARS = 500
+
+# ── Connection singleton ──────────────────────────────────────────────────────
+_db: Optional[aiosqlite.Connection] = None
+
+# session_id → session dict (id, title, file_id, llm_history); a write-through LRU, so reads of active chats
+# skip SQLite while memory stays bounded however many sessions exist
+_cache: "OrderedDict[str, dict]" = OrderedDict()
+CACHE_MAX_SESSIONS = 1000
+
+
+def _remember(session: dict):
+    _cache[session["id"]] = session
+    _cache.move_to_end(session["id"])
+    if len(_cache) > CACHE_MAX_SESSIONS:
+        _cache.popitem(last=False)
+
+
+async def get_db() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        DB_PATH.parent.mkdir(exist_ok=True)
+        db = await aiosqlite.connect(DB_PATH, isolation_level=None)
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id  TEXT PRIMARY KEY,
+                file_id     TEXT,
+                title       TEXT,
+                llm_history TEXT NOT NULL DEFAULT '[]'
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                body       TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id);
+            """
+        )
+        await _import_legacy(db)
+        _db = db
+    return _db
+
+
+async def close_db():
+    global _db
+    if _db:
+        await _db.close()
+        _db = None
+    _cache.clear()
+
+
+async def _import_legacy(db: aiosqlite.Connection):
+    """Move sessions.json (the old whole-file store) into the table, then drop it."""
+    if not LEGACY_JSON.exists():
+        return
+    try:
+        legacy = orjson.loads(LEGACY_JSON.read_bytes())
+    except Exception as e:
+        print(f"⚠️  Could not import {LEGACY_JSON.name}: {e}")
+        return
+    await db.executemany(
+        "INSERT OR IGNORE INTO sessions (session_id, file_id, title, llm_history) VALUES (?, ?, ?, ?)",
+        [
+            (sid, s.get("file_id"), s.get("title"), orjson.dumps(
+                [_llm_message(m) for m in s.get("messages", [])[-HISTORY_MAX_MESSAGES:]]
+            ).decode())
+            for sid, s in legacy.items()
+        ],
+    )
+    await db.executemany(
+        "INSERT INTO messages (session_id, body) VALUES (?, ?)",
+        [
+            (sid, orjson.dumps(m).decode())
+            for sid, s in legacy.items() for m in s.get("messages", [])
+        ],
+    )
+    LEGACY_JSON.unlink()
+    print(f"✅ Imported {len(legacy)} sessions from {LEGACY_JSON.name}")
+
+
+def _llm_message(message: dict) -> dict:
+    return {
+        "role": message["role"],
+        "content": message.get("content", message.get("explanation", ""))[:HISTORY_MAX_CHARS],
+    }
+
+
+def new_session(session_id: str, title: str, file_id: str) -> dict:
+    """An empty session; it is stored by its first append_messages."""
+    return {"id": session_id, "title": title, "file_id": file_id, "llm_history": []}
+
+
+# ── Session operations ───────────────────────────────────────────────────────
+
+# A session's messages folded back into one JSON array, in insertion order
+_MESSAGES_JSON = """
+    COALESCE((
+        SELECT json_group_array(json(body))
+        FROM (SELECT body FROM messages m WHERE m.session_id = s.session_id ORDER BY m.rowid)
+    ), '[]')
+"""
+
+async def get_session(session_id: str) -> Optional[dict]:
+    if session_id in _cache:
+        _cache.move_to_end(session_id)
+        return _cache[session_id]
+    db = await get_db()
+    async with db.execute(
+        "SELECT file_id, title, llm_history FROM sessions WHERE session_id = ?",
+        (session_id,),
+    ) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    file_id, title, llm_history = row
+    session = {"id": session_id, "title": title, "file_id": file_id, "llm_history": orjson.loads(llm_history)}
+    _remember(session)
+    return session
+
+
+async def append_messages(session: dict, messages: list[dict]):
+    """
+    Insert the new message rows and update session["llm_history"]; upserts
+    the session row, so this also creates new sessions.
+    """
+    llm_history = session["llm_history"]
+    llm_history.extend(_llm_message(m) for m in messages)
+    del llm_history[:-HISTORY_MAX_MESSAGES]
+    db = await get_db()
+    await db.execute(
+        """
+        INSERT INTO sessions (session_id, file_id, title, llm_history) VALUES (?, ?, ?, ?)
+        ON CONFLICT(session_id) DO UPDATE SET llm_history = excluded.llm_history
+        """,
+        (session["id"], session["file_id"], session["title"], orjson.dumps(llm_history).decode()),
+    )
+    await db.executemany(
+        "INSERT INTO messages (session_id, body) VALUES (?, ?)",
+        [(session["id"], orjson.dumps(m).decode()) for m in messages],
+    )
+    _remember(session)
+
+
+async def list_sessions(file_id: Optional[str] = None) -> list[dict]:
+    """All sessions (optionally for one file) in creation order."""
+    db = await get_db()
+    sql = f"SELECT session_id, file_id, title, {_MESSAGES_JSON} FROM sessions s"
+    params: tuple = ()
+    if file_id:
+        sql += " WHERE file_id = ?"
+        params = (file_id,)
+    async with db.execute(sql + " ORDER BY rowid", params) as cur:
+        rows = await cur.fetchall()
+    return [
+        {"id": sid, "title": title, "file_id": fid, "messages": orjson.loads(messages)}
+        for sid, fid, title, messages in rows
+    ]
+
+
+async def delete_session(session_id: str) -> bool:
+    db = await get_db()
+    cur = await db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    await db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+    _cache.pop(session_id, None)
+    return cur.rowcount > 0
@@ -0,0 +1,58 @@
+"""
+Parse-time guard for LLM-generated SQL, checked before DuckDB sees it.
+Only a single read-only query over the file's own table (and its CTEs) is
+allowed: no DDL/DML, ATTACH, COPY, file-reading table functions or other
+files' schemas.
+"""
+import sqlglot
+from sqlglot import exp
+from typing import Optional
+
+ALLOWED_TABLES = frozenset({"uploaded"})
+
+
+def validate_select(sql: str, limit: Optional[int] = None) -> str:
+    """
+    Return sql if it passes (raise ValueError otherwise). With limit, the
+    query returns at most limit rows, so DuckDB stops producing rows nobody
+    will see: it gets a LIMIT if it has none, and a larger explicit LIMIT is
+    lowered to limit (a smaller one is kept).
+    """
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="duckdb") if s is not None]
+    except sqlglot.errors.ParseError as e:
+        raise ValueError(f"Could not parse SQL: {e}") from None
+
+    if len(statements) != 1:
+        raise ValueError("Exactly one SQL statement is allowed.")
+    stmt = statements[0]
+    # Select, set operations (UNION/…) and WITH … SELECT are all exp.Query
+    if not isinstance(stmt, exp.Query):
+        raise ValueError("non-SELECT not allowed")
+
+    allowed = ALLOWED_TABLES | {cte.alias_or_name.lower() for cte in stmt.find_all(exp.CTE)}
+    for table in stmt.find_all(exp.Table):
+        if not isinstance(table.this, exp.Identifier) or table.args.get("db") or table.args.get("catalog"):
+            raise ValueError(f"Table source not allowed: {table.sql(dialect='duckdb')}")
+        if table.name.lower() not in allowed:
+            raise ValueError(f"Unknown table '{table.name}'; query the \"uploaded\" table.")
+
+    if limit is None:
+        return sql
+    limit = int(limit)
+    clause = stmt.args.get("limit")
+    if clause is None:
+        # Appended rather than re-generated from the tree, so the SQL DuckDB
+        # runs is the SQL shown to the user plus this clause (the newline
+        # keeps a trailing -- comment from swallowing it)
+        return f"{sql.rstrip().rstrip(';')}\nLIMIT {limit}"
+
+    value = clause.expression
+    options = clause.args.get("limit_options")
+    if isinstance(value, exp.Literal) and value.is_int and not (options and options.args.get("percent")):
+        if int(value.this) <= limit:
+            return sql
+        value.replace(exp.Literal.number(limit))
+        return stmt.sql(dialect="duckdb")
+    # An expression or percentage: cap whatever it yields from the outside
+    return f"SELECT * FROM (\n{sql.rstrip().rstrip(';')}\n) LIMIT {limit}"
@@ -1,36 +1,170 @@
 """
 Ollama HTTP client for Llama 3.1 8B.
 """
+import asyncio
+import contextlib
+import functools
+import hashlib
 import httpx
+import json
+import os
 import re
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
 
 OLLAMA_URL = "http://localhost:11434/api/generate"
 MODEL = "llama3.1:8b"
 TIMEOUT = httpx.Timeout(120.0)
 
+# One pooled client for every Ollama call so keep-alive connections are
+# reused; opened in the app lifespan (or lazily on first use) and closed there.
+# Ollama speaks plain HTTP/1.1, so concurrency comes from the pool size: each
+# /query runs two calls at once (classify and the speculative SQL).
+LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=300.0)
+_client: Optional[httpx.AsyncClient] = None
 
-async def _call_ollama(prompt: str, temperature: float = 0.0, max_tokens: int = 512) -> str:
-    payload = {
+# Ollama runs this many generations at once and queues the rest; waiting
+# here instead keeps a burst from piling up on its queue (and its timeouts)
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+_slots: Optional[asyncio.Semaphore] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client, _slots
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=TIMEOUT, limits=LIMITS)
+        _slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    return _client
+
+
+async def close_client():
+    global _client, _slots
+    if _client:
+        await _client.aclose()
+        _client = None
+        _slots = None
+
+
+def _payload(prompt: str, temperature: float, max_tokens: int, stream: bool) -> dict:
+    return {
         "model": MODEL,
         "prompt": prompt,
-        "stream": False,
+        "stream": stream,
         "options": {
             "temperature": temperature,
             "num_predict": max_tokens,
         },
     }
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        response = await client.post(OLLAMA_URL, json=payload)
+
+
+async def _stream_ollama(prompt: str, temperature: float = 0.0, max_tokens: int = 512):
+    """Yield the generated text piece by piece as Ollama streams it (NDJSON)."""
+    payload = _payload(prompt, temperature, max_tokens, stream=True)
+    client = get_client()
+    async with _slots, client.stream("POST", OLLAMA_URL, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                break
+
+
+async def _call_ollama(
+    prompt: str,
+    temperature: float = 0.0,
+    max_tokens: int = 512,
+    stop: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """
+    Run a generation. With a stop predicate the response is streamed and the
+    request is dropped as soon as stop(text_so_far) is true, so Ollama stops
+    generating tokens we would throw away.
+    """
+    if stop is None:
+        payload = _payload(prompt, temperature, max_tokens, stream=False)
+        client = get_client()
+        async with _slots:
+            response = await client.post(OLLAMA_URL, json=payload)
         response.raise_for_status()
         return response.json().get("response", "").strip()
 
+    text = ""
+    async with contextlib.aclosing(_stream_ollama(prompt, temperature, max_tokens)) as pieces:
+        async for piece in pieces:
+            text += piece
+            if stop(text):
+                break
+    return text.strip()
+
+
+# ── Response cache ────────────────────────────────────────────────────────────
+# (function, sha1(prompt)) → (stored_at, response). A prompt already embeds
+# the schema, sample, history and question, so a re-upload or a new turn
+# simply produces a different key — nothing needs invalidating.
+_response_cache: "OrderedDict[tuple[str, bytes], tuple[float, str]]" = OrderedDict()
+CACHE_MAX = 256
+CACHE_TTL = 3600.0
+
+# Same key → the generation already running; identical concurrent prompts
+# share it instead of each queueing a generation of its own
+_inflight: dict[tuple[str, bytes], asyncio.Future] = {}
+
+
+def _cached(fn):
+    @functools.wraps(fn)
+    async def wrapper(prompt: str) -> str:
+        key = (fn.__name__, hashlib.sha1(prompt.encode()).digest())
+        hit = _response_cache.get(key)
+        if hit and time.monotonic() - hit[0] < CACHE_TTL:
+            _response_cache.move_to_end(key)
+            return hit[1]
+
+        while (pending := _inflight.get(key)) is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this caller was cancelled, not the shared call
+                # the caller that started it was cancelled: start our own
+
+        future = asyncio.get_running_loop().create_future()
+        # Failures reach the waiters; don't also log them as never retrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        _inflight[key] = future
+        try:
+            result = await fn(prompt)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if _inflight.get(key) is future:
+                del _inflight[key]
+        future.set_result(result)
 
+        if result:
+            _response_cache[key] = (time.monotonic(), result)
+            _response_cache.move_to_end(key)
+            if len(_response_cache) > CACHE_MAX:
+                _response_cache.popitem(last=False)
+        return result
+    return wrapper
+
+
+@_cached
 async def classify_question(prompt: str) -> str:
     """
     Returns one of: 'SQL', 'COMPUTE', 'GENERAL'
     Uses very low token count since we only need one word back.
     """
-    raw = await _call_ollama(prompt, temperature=0.0, max_tokens=5)
+    raw = await _call_ollama(prompt, temperature=0.0, max_tokens=5, stop=_first_word_done)
     # Extract the classification word robustly
     upper = raw.strip().upper()
     for label in ("COMPUTE", "GENERAL", "SQL"):
@@ -39,43 +173,108 @@ async def classify_question(prompt: str) -> str:
     return "SQL"  # default to SQL if uncertain
 
 
+@_cached
 async def generate_sql(prompt: str) -> str:
-    raw = await _call_ollama(prompt, temperature=0.0)
+    raw = await _call_ollama(prompt, temperature=0.0, stop=_sql_complete)
     return _clean_sql(raw)
 
 
+@_cached
 async def explain_results(prompt: str) -> str:
     return await _call_ollama(prompt, temperature=0.3)
 
 
+async def stream_explanation(prompt: str):
+    """explain_results, token by token (for the streaming /query endpoint)."""
+    async with contextlib.aclosing(_stream_ollama(prompt, temperature=0.3)) as pieces:
+        async for piece in pieces:
+            yield piece
+
+
 async def answer_general(prompt: str) -> str:
     """Answer a question directly without SQL (definitions, conversions, advice)."""
     return await _call_ollama(prompt, temperature=0.1, max_tokens=400)
 
 
+async def warm_up():
+    """Ask Ollama to load the model (a request with no prompt); errors are ignored."""
+    try:
+        client = get_client()
+        async with _slots:
+            await client.post(OLLAMA_URL, json={"model": MODEL})
+    except Exception:
+        pass
+
+
 async def check_ollama_health() -> bool:
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(3.0)) as client:
-            r = await client.get("http://localhost:11434/api/tags")
-            return r.status_code == 200
+        r = await get_client().get("http://localhost:11434/api/tags", timeout=3.0)
+        return r.status_code == 200
     except Exception:
         return False
 
 
+_FENCE_RE = re.compile(r"```(?:sql)?\s*(.*?)```", re.IGNORECASE | re.DOTALL)
+_STATEMENT_RE = re.compile(r"\b(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+_SQL_KEYWORDS = frozenset({
+    "SELECT", "FROM", "WHERE", "GROUP", "ORDER", "HAVING", "LIMIT",
+    "JOIN", "LEFT", "RIGHT", "INNER", "OUTER", "ON", "AND", "OR",
+    "CASE", "WHEN", "THEN", "ELSE", "END", "AS", "BY", "WITH",
+    "UNION", "CAST", "COUNT", "SUM", "AVG", "MIN", "MAX",
+    "DISTINCT", "NOT", "NULL", "IS", "IN", "ROUND",
+})
+# A line of prose: starts like a sentence ("The query…") and its first word
+# is not a SQL keyword (compared case-insensitively).
+_PROSE_LINE_RE = re.compile(
+    r"^[ \t]*(?!(?i:" + "|".join(sorted(_SQL_KEYWORDS)) + r")(?:\s|$))[A-Z][a-z]",
+    re.MULTILINE,
+)
+
+_FIRST_WORD_RE = re.compile(r"\s*\S+\s")
+
+
+def _first_word_done(text: str) -> bool:
+    return _FIRST_WORD_RE.match(text) is not None
+
+
+def _sql_complete(text: str) -> bool:
+    """True once the streamed text already holds everything _clean_sql will keep."""
+    fences = text.count("```")
+    if fences % 2:
+        return False  # inside a code fence: its SQL is still coming
+    if fences:
+        return _FENCE_RE.search(text) is not None  # _clean_sql takes the fenced SQL
+    start = _STATEMENT_RE.search(text)
+    # A keyword in the middle of a line is prose ("the query with a filter:");
+    # a fence may still follow, so only SQL starting a line can end early
+    if not start or text[text.rfind("\n", 0, start.start()) + 1:start.start()].strip():
+        return False
+    body = text[start.start():]
+    # End of the first statement
+    if ";" in body:
+        return True
+    # A finished line of prose after the SQL (only whole lines, so a keyword
+    # still being streamed is not mistaken for a sentence)
+    complete = body[:body.rfind("\n") + 1]
+    first_nl = complete.find("\n")
+    return first_nl != -1 and _PROSE_LINE_RE.search(complete, first_nl + 1) is not None
+
+
 def _clean_sql(raw: str) -> str:
     """Aggressively extract just the SQL from LLM output."""
     if not raw:
         return ""
 
     # Strip markdown code fences
-    fence = re.search(r"```(?:sql)?\s*(.*?)```", raw, re.IGNORECASE | re.DOTALL)
+    fence = _FENCE_RE.search(raw)
     if fence:
         raw = fence.group(1).strip()
 
     raw = raw.replace("`", "").strip()
 
     # Find first SQL keyword
-    match = re.search(r"\b(SELECT|WITH|INSERT|UPDATE|DELETE)\b", raw, re.IGNORECASE)
+    match = _STATEMENT_RE.search(raw)
     if match:
         raw = raw[match.start():]
 
@@ -84,20 +283,11 @@ def _clean_sql(raw: str) -> str:
     if parts:
         raw = parts[0]
 
-    # Remove trailing prose lines
-    sql_keywords = {
-        "SELECT", "FROM", "WHERE", "GROUP", "ORDER", "HAVING", "LIMIT",
-        "JOIN", "LEFT", "RIGHT", "INNER", "OUTER", "ON", "AND", "OR",
-        "CASE", "WHEN", "THEN", "ELSE", "END", "AS", "BY", "WITH",
-        "UNION", "CAST", "COUNT", "SUM", "AVG", "MIN", "MAX",
-        "DISTINCT", "NOT", "NULL", "IS", "IN", "ROUND",
-    }
-    sql_lines = []
-    for line in raw.splitlines():
-        stripped = line.strip()
-        first_word = stripped.split()[0].upper() if stripped.split() else ""
-        if sql_lines and first_word not in sql_keywords and re.match(r'^[A-Z][a-z]', stripped):
-            break
-        sql_lines.append(line)
-
-    return "\n".join(sql_lines).strip()
+    # Remove trailing prose lines (the first line is always kept)
+    first_nl = raw.find("\n")
+    if first_nl != -1:
+        prose = _PROSE_LINE_RE.search(raw, first_nl + 1)
+        if prose:
+            raw = raw[:prose.start()]
+
+    return raw.strip()
@@ -1,6 +1,14 @@
 """
 Builds prompts for question routing, SQL generation, and result explanation.
 """
+import csv
+import functools
+import io
+import itertools
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
 
 # ── Live exchange rates (hardcoded; update or fetch dynamically if needed) ───
 EXCHANGE_RATES = {
@@ -11,17 +19,36 @@ EXCHANGE_RATES = {
     "CAD": 1.36,
     "AUD": 1.53,
 }
+_RATE_LINES = "\n".join(f"  1 USD = {v} {k}" for k, v in EXCHANGE_RATES.items())
+
+# Static tail of the classification prompt
+_CLASSIFY_RULES = """Classify this question into exactly one of these categories:
+  SQL     - The question asks for data from the dataset (counts, averages, filters, top-N, distributions, etc.)
+  COMPUTE - The question asks for a calculation that combines dataset data with external math (currency conversion, unit conversion, percentage of a known total, etc.)
+  GENERAL - The question does not need the dataset at all (definitions, explanations, general knowledge, advice)
+
+Reply with ONLY one word: SQL, COMPUTE, or GENERAL. Nothing else."""
+
+
+# Ollama's default context window, minus room for generate_sql's 512 tokens
+MAX_CTX = 2048
+PROMPT_TOKEN_BUDGET = MAX_CTX - 512
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) — good enough to trim by."""
+    return len(text) >> 2
 
 
-def _format_history(history: list[dict] = None) -> str:
-    if not history:
+def _format_history(history: list[dict] = None, last: int = 4) -> str:
+    if not history or not last:
         return ""
-    res = "\nPREVIOUS CONVERSATION HISTORY:\n"
-    for msg in history[-4:]:  # last 4 messages to save context
+    lines = ["", "PREVIOUS CONVERSATION HISTORY:"]
+    for i in range(max(0, len(history) - last), len(history)):  # last few messages to save context
+        msg = history[i]
         role = "User" if msg["role"] == "user" else "Assistant"
-        res += f"{role}: {msg['content']}\n"
-    res += "\n"
-    return res
+        lines.append(f"{role}: {msg['content']}")
+    return "\n".join(lines) + "\n\n"
 
 
 def build_classify_prompt(question: str, schema_available: bool, schema_columns: list[str] = None, history: list[dict] = None) -> str:
@@ -40,36 +67,123 @@ def build_classify_prompt(question: str, schema_available: bool, schema_columns:
 {_format_history(history)}
 User question: "{question}"
 
-Classify this question into exactly one of these categories:
-  SQL     - The question asks for data from the dataset (counts, averages, filters, top-N, distributions, etc.)
-  COMPUTE - The question asks for a calculation that combines dataset data with external math (currency conversion, unit conversion, percentage of a known total, etc.)
-  GENERAL - The question does not need the dataset at all (definitions, explanations, general knowledge, advice)
-
-Reply with ONLY one word: SQL, COMPUTE, or GENERAL. Nothing else."""
+{_CLASSIFY_RULES}"""
 
 
-def build_sql_prompt(question: str, schema: dict, history: list[dict] = None) -> str:
-    table = schema["table_name"]
-    col_lines = "\n".join(
-        f"  - {c['name']} ({c['type']})" for c in schema["columns"]
+def _schema_key(schema: dict) -> tuple:
+    """Hashable identity of everything _render_schema_block reads from a schema."""
+    return (
+        schema["table_name"],
+        tuple((c["name"], c["type"]) for c in schema["columns"]),
+        tuple(tuple(row.items()) for row in schema.get("sample", [])[:15]),
     )
-    sample_rows = schema.get("sample", [])
-    sample_str = ""
+
+
+def _pipe_rows(rows) -> str:
+    """Render rows as '|'-separated lines with the C csv writer (one line per row)."""
+    buf = io.StringIO()
+    csv.writer(buf, delimiter="|", lineterminator="\n").writerows(rows)
+    return buf.getvalue()
+
+
+_TEXT_TYPES = ("VARCHAR", "TEXT", "CHAR", "STRING")
+_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+SCHEMA_BLOCK_CACHE = 32  # schemas whose rendered block is kept
+
+
+@functools.lru_cache(maxsize=SCHEMA_BLOCK_CACHE)
+def _render_schema_block(key: tuple) -> dict:
+    """
+    Every schema-derived fragment the SQL, compute and retry prompts use.
+    These only change when a dataset is (re)uploaded, so they are rendered
+    once per schema rather than once per question.
+    """
+    table, columns, sample_rows = key
+    col_lines = "\n".join(f"  - {name} ({ctype})" for name, ctype in columns)
+    text_cols = [name for name, ctype in columns if ctype.upper() in _TEXT_TYPES]
+
+    sample_str = short_sample_str = compute_sample_str = ""
     if sample_rows:
-        headers = list(sample_rows[0].keys())
-        sample_str = "\nSample data (first 15 rows):\n"
-        sample_str += " | ".join(headers) + "\n"
-        sample_str += "-" * 60 + "\n"
-        for row in sample_rows[:15]:
-            sample_str += " | ".join(str(v) for v in row.values()) + "\n"
+        header = _pipe_rows([[k for k, _ in sample_rows[0]]])
+        values = [[v for _, v in row] for row in sample_rows]
+        sample_str = "\nSample data (first 15 rows):\n" + header + "-" * 60 + "\n" + _pipe_rows(values)
+        short_sample_str = "\nSample data (first 5 rows):\n" + header + "-" * 60 + "\n" + _pipe_rows(values[:5])
+        compute_sample_str = "\nSample data:\n" + header + _pipe_rows(values[:5])
+
+    # VARCHAR columns whose sample values look numeric
+    first_rows = [dict(row) for row in sample_rows[:5]]
+    varchar_numeric_hints = []
+    for name in text_cols:
+        looks_numeric = 0
+        for row in first_rows:
+            v = row.get(name)
+            if v is not None and _NUM_RE.fullmatch(str(v).strip()):
+                looks_numeric += 1
+                if looks_numeric >= 2:
+                    varchar_numeric_hints.append(name)
+                    break
+
+    compute_cast_hint = ""
+    if varchar_numeric_hints:
+        examples = ", ".join(varchar_numeric_hints)
+        compute_cast_hint = f"\n⚠️  These columns are stored as text but contain numbers — ALWAYS use TRY_CAST when aggregating them: {examples}"
+        compute_cast_hint += f"\n   Example: SELECT ROUND(SUM(TRY_CAST({varchar_numeric_hints[0]} AS DOUBLE)) * 86.5, 2) AS result FROM \"{table}\""
 
-    return f"""You are a DuckDB SQL expert. Your ONLY job is to output a single SQL SELECT query.
+    retry_cast_hint = ""
+    if text_cols:
+        retry_cast_hint = (
+            f"\n⚠️  Common fix: these columns are VARCHAR — wrap numeric aggregations with TRY_CAST:\n"
+            + "\n".join(f"   TRY_CAST({c} AS DOUBLE)" for c in text_cols[:4])
+        )
+
+    return {
+        "col_lines": col_lines,
+        "sample_str": sample_str,
+        "short_sample_str": short_sample_str,
+        "compute_sample_str": compute_sample_str,
+        "compute_cast_hint": compute_cast_hint,
+        "retry_cast_hint": retry_cast_hint,
+    }
+
+
+# fingerprint → schema block for uploaded tables, whose fingerprint (see
+# duck.get_schema_fingerprint) already identifies columns and sample rows
+_blocks_by_fingerprint: "OrderedDict[str, dict]" = OrderedDict()
+_blocks_lock = threading.Lock()  # prompts are built from worker threads
+
+
+def _schema_block(schema: dict) -> dict:
+    fingerprint = schema.get("fingerprint")
+    if fingerprint is None:
+        # PostgreSQL schemas carry no fingerprint: key on the content itself
+        key = _schema_key(schema)
+        try:
+            return _render_schema_block(key)
+        except TypeError:  # unhashable sample value (e.g. a JSON column)
+            return _render_schema_block.__wrapped__(key)
+
+    with _blocks_lock:
+        block = _blocks_by_fingerprint.get(fingerprint)
+        if block is not None:
+            _blocks_by_fingerprint.move_to_end(fingerprint)
+            return block
+    block = _render_schema_block.__wrapped__(_schema_key(schema))
+    with _blocks_lock:
+        _blocks_by_fingerprint[fingerprint] = block
+        if len(_blocks_by_fingerprint) > SCHEMA_BLOCK_CACHE:
+            _blocks_by_fingerprint.popitem(last=False)
+    return block
+
+
+# Static pieces of the SQL prompts; only table, schema block, history and
+# question are spliced in per call
+_SQL_PROMPT_HEAD = """You are a DuckDB SQL expert. Your ONLY job is to output a single SQL SELECT query.
 
 DATABASE INFO:
-Table name (exact, case-sensitive): {table}
-Columns (use EXACTLY these names, lowercase):
-{col_lines}
-{sample_str}
+Table name (exact, case-sensitive): """
+_SQL_PROMPT_RULES = """
 STRICT RULES — violating any rule makes your answer wrong:
 1. Output THE SQL QUERY ONLY. Zero other text. No explanation, no greeting, no notes.
 2. No markdown. No backticks. No ```sql blocks. Just raw SQL starting with SELECT.
@@ -80,66 +194,50 @@ STRICT RULES — violating any rule makes your answer wrong:
 7. For YES/NO columns, values are exactly 'Yes' or 'No' (capital first letter).
 8. Never use subqueries when a simple GROUP BY works.
 9. If aggregating a column that might be stored as text, wrap it: TRY_CAST(colname AS DOUBLE)
-   Example: SELECT SUM(TRY_CAST(totalcharges AS DOUBLE)) AS total_revenue FROM "{table}"
+   Example: SELECT SUM(TRY_CAST(totalcharges AS DOUBLE)) AS total_revenue FROM \""""
+_SQL_PROMPT_ANTI = """"
 10. ANTI-HALLUCINATION: If the user asks for a column or metric NOT in the column list, DO NOT invent it. Output exactly: SELECT 'Column not found' AS error;
-{_format_history(history)}
-USER QUESTION: {question}
+"""
+_SQL_PROMPT_TAIL = """
 
 SQL (start with SELECT, nothing before it):"""
 
 
-def build_compute_sql_prompt(question: str, schema: dict, history: list[dict] = None) -> str:
-    """
-    Computation-aware SQL prompt: allows inline math, currency conversion, etc.
-    Detects which columns are numeric (or might be stored as VARCHAR numbers)
-    so the LLM knows to use TRY_CAST.
-    """
-    table = schema["table_name"]
-    col_lines = "\n".join(f"  - {c['name']} ({c['type']})" for c in schema["columns"])
+# (sample block, history messages) to fall back through, largest first, when
+# a prompt would not fit PROMPT_TOKEN_BUDGET
+_SQL_TRIM_STEPS = (
+    ("sample_str", 4), ("short_sample_str", 4), ("short_sample_str", 2), (None, 2), (None, 0),
+)
+_COMPUTE_TRIM_STEPS = (("compute_sample_str", 4), ("compute_sample_str", 2), (None, 2), (None, 0))
 
-    # Detect VARCHAR columns that look like they could be numeric from sample data
-    varchar_numeric_hints = []
-    for col in schema.get("columns", []):
-        if col["type"].upper() in ("VARCHAR", "TEXT", "CHAR", "STRING"):
-            # Check sample values: if they look numeric, flag this column
-            sample_vals = [
-                str(row.get(col["name"], "")).strip()
-                for row in schema.get("sample", [])[:5]
-                if row.get(col["name"]) is not None
-            ]
-            looks_numeric = sum(
-                1 for v in sample_vals if v.replace(".", "", 1).replace("-", "", 1).isdigit()
-            )
-            if looks_numeric >= 2:
-                varchar_numeric_hints.append(col["name"])
 
-    cast_hint = ""
-    if varchar_numeric_hints:
-        examples = ", ".join(varchar_numeric_hints)
-        cast_hint = f"\n⚠️  These columns are stored as text but contain numbers — ALWAYS use TRY_CAST when aggregating them: {examples}"
-        cast_hint += f"\n   Example: SELECT ROUND(SUM(TRY_CAST({varchar_numeric_hints[0]} AS DOUBLE)) * 86.5, 2) AS result FROM \"{table}\""
+def build_sql_prompt(question: str, schema: dict, history: list[dict] = None) -> str:
+    table = schema["table_name"]
+    block = _schema_block(schema)
 
-    # Build rate hint
-    rate_lines = "\n".join(f"  1 USD = {v} {k}" for k, v in EXCHANGE_RATES.items())
+    for sample_key, last in _SQL_TRIM_STEPS:
+        prompt = "".join([
+            _SQL_PROMPT_HEAD, table,
+            "\nColumns (use EXACTLY these names, lowercase):\n", block["col_lines"], "\n",
+            block[sample_key] if sample_key else "",
+            _SQL_PROMPT_RULES, table, _SQL_PROMPT_ANTI,
+            _format_history(history, last),
+            "\nUSER QUESTION: ", question,
+            _SQL_PROMPT_TAIL,
+        ])
+        if _estimate_tokens(prompt) <= PROMPT_TOKEN_BUDGET:
+            break
+    return prompt
 
-    sample_rows = schema.get("sample", [])
-    sample_str = ""
-    if sample_rows:
-        headers = list(sample_rows[0].keys())
-        sample_str = "\nSample data:\n" + " | ".join(headers) + "\n"
-        for row in sample_rows[:5]:
-            sample_str += " | ".join(str(v) for v in row.values()) + "\n"
 
-    return f"""You are a DuckDB SQL expert. Generate SQL that answers the user's question, including any required math.
+_COMPUTE_PROMPT_HEAD = """You are a DuckDB SQL expert. Generate SQL that answers the user's question, including any required math.
 
 DATABASE INFO:
-Table: {table}
-Columns:
-{col_lines}
-{sample_str}{cast_hint}
+Table: """
+_COMPUTE_PROMPT_RULES = f"""
 
 EXCHANGE RATES (use directly in SQL arithmetic as multipliers):
-{rate_lines}
+{_RATE_LINES}
 
 RULES:
 1. Output ONLY the raw SQL query. No markdown, no backticks, no explanation.
@@ -152,44 +250,42 @@ RULES:
 8. ANTI-HALLUCINATION: If the user asks for a column or metric NOT in the column list, DO NOT invent it. Output exactly: SELECT 'Column not found' AS error;
 
 Good examples:
-  Revenue in INR : SELECT ROUND(SUM(TRY_CAST(totalcharges AS DOUBLE)) * 86.5, 2) AS total_revenue_inr FROM "{table}"
-  Avg charge EUR : SELECT ROUND(AVG(TRY_CAST(monthlycharges AS DOUBLE)) * 0.92, 2) AS avg_monthly_eur FROM "{table}"
-{_format_history(history)}
-USER QUESTION: {question}
+  Revenue in INR : SELECT ROUND(SUM(TRY_CAST(totalcharges AS DOUBLE)) * 86.5, 2) AS total_revenue_inr FROM \""""
+_COMPUTE_PROMPT_EXAMPLE = """"
+  Avg charge EUR : SELECT ROUND(AVG(TRY_CAST(monthlycharges AS DOUBLE)) * 0.92, 2) AS avg_monthly_eur FROM \""""
+_COMPUTE_PROMPT_TAIL = """
 
 SQL:"""
 
 
-def build_retry_sql_prompt(question: str, schema: dict, bad_sql: str, error: str) -> str:
+def build_compute_sql_prompt(question: str, schema: dict, history: list[dict] = None) -> str:
+    """
+    Computation-aware SQL prompt: allows inline math, currency conversion, etc.
+    Detects which columns are numeric (or might be stored as VARCHAR numbers)
+    so the LLM knows to use TRY_CAST.
+    """
     table = schema["table_name"]
-    col_lines = "\n".join(f"  - {c['name']} ({c['type']})" for c in schema["columns"])
-
-    # Identify VARCHAR columns that look numeric (likely cause of type errors)
-    varchar_numeric = [
-        c["name"] for c in schema.get("columns", [])
-        if c["type"].upper() in ("VARCHAR", "TEXT", "CHAR", "STRING")
-    ]
-    cast_hint = ""
-    if varchar_numeric:
-        cast_hint = (
-            f"\n⚠️  Common fix: these columns are VARCHAR — wrap numeric aggregations with TRY_CAST:\n"
-            + "\n".join(f"   TRY_CAST({c} AS DOUBLE)" for c in varchar_numeric[:4])
-        )
+    block = _schema_block(schema)
 
-    return f"""You are a DuckDB SQL expert. Your previous SQL failed. Output ONLY the corrected SQL.
+    for sample_key, last in _COMPUTE_TRIM_STEPS:
+        prompt = "".join([
+            _COMPUTE_PROMPT_HEAD, table,
+            "\nColumns:\n", block["col_lines"], "\n",
+            block[sample_key] if sample_key else "", block["compute_cast_hint"],
+            _COMPUTE_PROMPT_RULES, table, _COMPUTE_PROMPT_EXAMPLE, table, '"\n',
+            _format_history(history, last),
+            "\nUSER QUESTION: ", question,
+            _COMPUTE_PROMPT_TAIL,
+        ])
+        if _estimate_tokens(prompt) <= PROMPT_TOKEN_BUDGET:
+            break
+    return prompt
 
-Table: {table}
-Valid columns ONLY:
-{col_lines}
-{cast_hint}
 
-FAILED SQL:
-{bad_sql}
+_RETRY_PROMPT_HEAD = """You are a DuckDB SQL expert. Your previous SQL failed. Output ONLY the corrected SQL.
 
-ERROR MESSAGE:
-{error}
-
-USER QUESTION: {question}
+Table: """
+_RETRY_PROMPT_TAIL = """
 
 FIX RULES:
 - Output ONLY the corrected SQL. No explanation. No markdown. No backticks.
@@ -200,6 +296,19 @@ FIX RULES:
 CORRECTED SQL:"""
 
 
+def build_retry_sql_prompt(question: str, schema: dict, bad_sql: str, error: str) -> str:
+    block = _schema_block(schema)
+
+    return "".join([
+        _RETRY_PROMPT_HEAD, schema["table_name"],
+        "\nValid columns ONLY:\n", block["col_lines"], "\n", block["retry_cast_hint"],
+        "\n\nFAILED SQL:\n", bad_sql,
+        "\n\nERROR MESSAGE:\n", error,
+        "\n\nUSER QUESTION: ", question,
+        _RETRY_PROMPT_TAIL,
+    ])
+
+
 def build_general_answer_prompt(question: str, schema: dict = None, history: list[dict] = None) -> str:
     """For questions that don't require a database query."""
     context = ""
@@ -218,15 +327,42 @@ Do NOT use markdown headers. Keep the response under 5 sentences unless a list i
 IMPORTANT ANTI-HALLUCINATION RULE: Answer ONLY based on the provided context or general knowledge about data analytics. Do not invent information about the dataset. If you cannot answer based on the data, state 'I do not have enough specific data to answer this'."""
 
 
-def build_explanation_prompt(question: str, sql: str, results: list[dict]) -> str:
+# Rows from each end of a result shown to the explanation prompt
+EXPLAIN_HEAD_ROWS = 10
+EXPLAIN_TAIL_ROWS = 10
+
+
+def build_explanation_prompt(
+    question: str, sql: str, results: list[dict],
+    total: Optional[int] = None, truncated: bool = False,
+) -> str:
+    """
+    results may already be a head + tail sample of a bigger result; total is
+    then the full row count (defaults to len(results)). truncated means the
+    query itself was cut off at total rows, so total is only a lower bound.
+    """
+    if total is None:
+        total = len(results)
+    if len(results) > EXPLAIN_HEAD_ROWS + EXPLAIN_TAIL_ROWS:
+        results = results[:EXPLAIN_HEAD_ROWS] + results[-EXPLAIN_TAIL_ROWS:]
+
     result_preview = ""
     if results:
-        headers = list(results[0].keys())
-        result_preview = " | ".join(headers) + "\n"
-        for row in results[:10]:
-            result_preview += " | ".join(
-                str(round(v, 2) if isinstance(v, float) else v) for v in row.values()
-            ) + "\n"
+        result_preview = _pipe_rows([results[0].keys()]) + _pipe_rows(
+            [round(v, 2) if isinstance(v, float) else v for v in row.values()]
+            for row in results
+        )
+        if truncated and total > len(results):
+            result_preview += (
+                f"(first {EXPLAIN_HEAD_ROWS} and rows {total - EXPLAIN_TAIL_ROWS + 1}-{total} "
+                f"of at least {total} rows)\n"
+            )
+        elif truncated:
+            result_preview += f"(first {total} rows of a longer result)\n"
+        elif total > len(results):
+            result_preview += (
+                f"(first {EXPLAIN_HEAD_ROWS} and last {EXPLAIN_TAIL_ROWS} of {total} rows)\n"
+            )
 
     return f"""You are a friendly data analyst helping a non-technical business user understand data.
 
@@ -240,15 +376,38 @@ Do NOT mention SQL, databases, queries, or technical terms.
 Do NOT use markdown. Plain text only."""
 
 
+def kpi_explanation(columns: list[str], rows: list[dict]) -> Optional[str]:
+    """
+    Plain-English sentence for a single all-numeric result row, filled in
+    server-side so KPI answers don't need an explanation round-trip to the LLM.
+    Returns None when the result isn't that simple.
+    """
+    if len(rows) != 1 or not columns:
+        return None
+    row = rows[0]
+    parts = []
+    for col in columns:
+        v = row.get(col)
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            return None
+        value = f"{v:,}" if isinstance(v, int) else f"{round(v, 2):,}"
+        parts.append(f"the {col.replace('_', ' ')} is {value}")
+    sentence = "; ".join(parts)
+    return sentence[0].upper() + sentence[1:] + "."
+
+
+_TIME_COLS = frozenset({"date", "month", "year", "time", "tenure", "period"})
+
+
 def suggest_chart_type(columns: list[str], rows: list[dict]) -> str:
     if not rows:
         return "none"
     if len(rows) == 1:
         return "kpi"
     if len(columns) == 2:
-        val = list(rows[0].values())[1]
+        val = next(itertools.islice(rows[0].values(), 1, None), None)
         if isinstance(val, (int, float)):
-            if any(k.lower() in ("date", "month", "year", "time", "tenure", "period") for k in columns):
+            if any(k.lower() in _TIME_COLS for k in columns):
                 return "line"
             return "bar"
     if len(columns) >= 2:
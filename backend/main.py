@@ -11,12 +11,19 @@ from backend.routes import data as data_routes
 from backend.routes import files as files_routes
 from backend.db import postgres as pg_db
 from backend.db import duck
+from backend.db import sessions
+from backend.llm import ollama_client
+from backend.responses import ORJSONResponse
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Restore all previously uploaded CSVs into memory
     duck.restore_all()
+    # Chat session store (SQLite)
+    await sessions.get_db()
+    # Shared keep-alive HTTP client for Ollama
+    ollama_client.get_client()
     # Open PostgreSQL connection pool
     try:
         await pg_db.get_pool()
@@ -24,6 +31,9 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"⚠️  PostgreSQL unavailable: {e}")
     yield
+    duck.flush_meta()
+    await ollama_client.close_client()
+    await sessions.close_db()
     await pg_db.close_pool()
     print("PostgreSQL pool closed")
 
@@ -33,6 +43,7 @@ app = FastAPI(
     description="Upload CSVs, ask NL questions, get data-backed answers. Powered by DuckDB + PostgreSQL + Llama 3.1.",
     version="3.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -43,17 +54,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# File management
-app.include_router(files_routes.router)
-
-# DuckDB routes
-app.include_router(upload.router,     tags=["DuckDB — Data"])
-app.include_router(query.router,      tags=["DuckDB — Query"])
-app.include_router(stats.router,      tags=["DuckDB — Stats"])
-app.include_router(data_routes.router)
-
-# PostgreSQL routes
-app.include_router(pg_routes.router)
+ROUTERS = (
+    # File management
+    (files_routes.router, None),
+    # DuckDB routes
+    (upload.router,       ["DuckDB — Data"]),
+    (query.router,        ["DuckDB — Query"]),
+    (stats.router,        ["DuckDB — Stats"]),
+    (data_routes.router,  None),
+    # PostgreSQL routes
+    (pg_routes.router,    None),
+)
+for router, tags in ROUTERS:
+    app.include_router(router, tags=tags)
 
 
 @app.get("/", tags=["Root"])
@@ -1,47 +1,59 @@
 """
 JSON data layer — serve the raw CSV dataset as JSON, scoped to a file_id.
 
-GET  /data?file_id=              → full dataset (capped at 5000 rows)
+GET  /data?file_id=              → dataset rows (capped at 5000, paginate with offset)
 GET  /data/sample?file_id=       → first 20 rows
 GET  /data/columns?file_id=      → column names + types
 GET  /data/column/{col}?file_id= → all values for one column
 GET  /data/counts/{col}?file_id= → value → count map (pie/bar ready)
 """
+import orjson
 from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from backend.db import duck
+from backend.responses import ORJSONResponse
 
 router = APIRouter(prefix="/data", tags=["JSON Data"])
 
 
-def _require(file_id: str):
-    data = duck.get_json_data(file_id)
+def _require(file_id: str) -> dict:
     schema = duck.get_schema(file_id)
-    if data is None or schema is None:
+    if schema is None:
         raise HTTPException(
             status_code=404,
             detail=f"No dataset for file_id '{file_id}'. Upload a CSV first."
         )
-    return data, schema
+    return schema
 
 
 @router.get("")
-async def get_data(file_id: str = Query(...), limit: int = 5000):
-    data, schema = _require(file_id)
-    return JSONResponse(content={
+async def get_data(file_id: str = Query(...), limit: int = Query(5000, ge=0), offset: int = Query(0, ge=0)):
+    schema = _require(file_id)
+    head = orjson.dumps({
         "file_id":       file_id,
         "filename":      schema.get("filename", ""),
-        "total_rows":    len(data),
-        "returned_rows": min(len(data), limit),
+        "total_rows":    schema["row_count"],
+        "returned_rows": max(0, min(limit, schema["row_count"] - offset)),
         "columns":       [c["name"] for c in schema["columns"]],
-        "rows":          data[:limit],
     })
 
+    # Rows are serialized batch by batch, so memory stays flat whatever the limit
+    def body():
+        yield head[:-1] + b',"rows":['
+        sep = b""
+        for batch in duck.iter_json_data(file_id, limit=limit, offset=offset):
+            yield sep + b",".join(orjson.dumps(row) for row in batch)
+            sep = b","
+        yield b"]}"
+
+    return StreamingResponse(body(), media_type="application/json")
+
 
 @router.get("/sample")
-async def get_sample(file_id: str = Query(...), n: int = 20):
-    data, _ = _require(file_id)
-    return JSONResponse(content={"rows": data[:n], "total_rows": len(data)})
+async def get_sample(file_id: str = Query(...), n: int = Query(20, ge=0)):
+    schema = _require(file_id)
+    rows = duck.get_json_data(file_id, limit=n)
+    return ORJSONResponse(content={"rows": rows, "total_rows": schema["row_count"]})
 
 
 @router.get("/columns")
@@ -54,23 +66,22 @@ async def get_columns(file_id: str = Query(...)):
 
 @router.get("/column/{col_name}")
 async def get_column_values(col_name: str, file_id: str = Query(...)):
-    _, schema = _require(file_id)
-    valid = [c["name"] for c in schema["columns"]]
-    if col_name not in valid:
+    schema = _require(file_id)
+    if not duck.has_column(file_id, col_name):
+        valid = [c["name"] for c in schema["columns"]]
         raise HTTPException(status_code=400, detail=f"Column '{col_name}' not found. Available: {valid}")
     values = duck.get_column_values(file_id, col_name)
-    return JSONResponse(content={"column": col_name, "values": values, "count": len(values)})
+    return ORJSONResponse(content={"column": col_name, "values": values, "count": len(values)})
 
 
 @router.get("/counts/{col_name}")
 async def get_value_counts(col_name: str, file_id: str = Query(...)):
-    _, schema = _require(file_id)
-    valid = [c["name"] for c in schema["columns"]]
-    if col_name not in valid:
+    schema = _require(file_id)
+    if not duck.has_column(file_id, col_name):
+        valid = [c["name"] for c in schema["columns"]]
         raise HTTPException(status_code=400, detail=f"Column '{col_name}' not found. Available: {valid}")
-    counts = duck.get_column_counts(file_id, col_name)
-    labels = list(counts.keys())
-    values = list(counts.values())
-    return JSONResponse(content={
-        "column": col_name, "labels": labels, "values": values, "total": sum(values),
+    labels, values = duck.get_column_counts(file_id, col_name)
+    # Every group (NULL included) is returned, so the counts add up to row_count
+    return ORJSONResponse(content={
+        "column": col_name, "labels": labels, "values": values, "total": schema["row_count"],
     })
@@ -3,25 +3,30 @@ GET  /files          — list all uploaded files
 DELETE /files/{id}   — remove a file
 GET  /files/{id}/schema — schema for a specific file
 """
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from backend.responses import ORJSONResponse
 from backend.db import duck
 
 router = APIRouter(prefix="/files", tags=["Files"])
 
 
 @router.get("")
-async def list_files():
-    return JSONResponse(content=duck.list_files())
+async def list_files(request: Request):
+    # The list only changes on upload/delete, so polling clients get a 304
+    etag = duck.files_etag()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return ORJSONResponse(content=duck.list_files(), headers={"ETag": etag})
 
 
 @router.delete("/{file_id}")
 async def delete_file(file_id: str):
-    files = {f["file_id"]: f for f in duck.list_files()}
-    if file_id not in files:
+    info = duck.get_file(file_id)
+    if info is None:
         raise HTTPException(status_code=404, detail=f"File '{file_id}' not found.")
     duck.delete_file(file_id)
-    return {"message": f"File '{files[file_id]['filename']}' deleted."}
+    return {"message": f"File '{info['filename']}' deleted."}
 
 
 @router.get("/{file_id}/schema")
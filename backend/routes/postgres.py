@@ -7,11 +7,11 @@ PostgreSQL-specific routes:
   POST /pg/upload/{table}      — upload CSV into a named PG table
   GET  /pg/health              — PostgreSQL connection check
 """
-import io
+import asyncio
 import pandas as pd
 from fastapi import APIRouter, HTTPException, File, UploadFile, Path
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from backend.responses import ORJSONResponse
 from backend.db import postgres as pg
 from backend.llm import ollama_client, prompt_builder
 
@@ -60,9 +60,10 @@ async def upload_to_pg(file: UploadFile = File(...)):
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="Only CSV files supported.")
 
-    contents = await file.read()
+    # Parse straight from the spooled upload in a worker thread so a big CSV
+    # neither gets copied into one bytes object nor blocks the event loop
     try:
-        df = pd.read_csv(io.BytesIO(contents))
+        df = await asyncio.to_thread(pd.read_csv, file.file)
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"CSV parse error: {e}")
 
@@ -74,7 +75,7 @@ async def upload_to_pg(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PostgreSQL load error: {e}")
 
-    return JSONResponse(content={
+    return ORJSONResponse(content={
         "message": f"Loaded {result['row_count']} rows into PostgreSQL table '{table_name}'.",
         "schema": result,
     })
@@ -92,14 +93,17 @@ async def pg_query(req: PGQueryRequest):
     if not question:
         raise HTTPException(status_code=400, detail="Question is empty.")
 
-    # Build schema context
+    # Build schema context while Ollama loads the model
     try:
-        schema = await pg.get_table_schema(req.table_name)
+        schema, _ = await asyncio.gather(
+            pg.get_table_schema(req.table_name),
+            ollama_client.warm_up(),
+        )
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Table '{req.table_name}' not found: {e}")
 
     # Step 1: Generate SQL
-    sql_prompt = prompt_builder.build_sql_prompt(question, schema)
+    sql_prompt = await asyncio.to_thread(prompt_builder.build_sql_prompt, question, schema)
     try:
         sql = await ollama_client.generate_sql(sql_prompt)
     except Exception as e:
@@ -109,7 +113,7 @@ async def pg_query(req: PGQueryRequest):
     try:
         rows, columns = await pg.execute_query(sql)
     except Exception as e:
-        return JSONResponse(status_code=422, content={
+        return ORJSONResponse(status_code=422, content={
             "error": f"SQL execution failed: {e}",
             "sql": sql,
             "rows": [], "columns": [],
@@ -118,16 +122,18 @@ async def pg_query(req: PGQueryRequest):
             "source": "postgresql",
         })
 
-    # Step 3: Explain
-    try:
-        explain_prompt = prompt_builder.build_explanation_prompt(question, sql, rows)
-        explanation = await ollama_client.explain_results(explain_prompt)
-    except Exception:
-        explanation = "Results retrieved from PostgreSQL."
+    # Step 3: Explain (single-number results are described from a template)
+    explanation = prompt_builder.kpi_explanation(columns, rows)
+    if explanation is None:
+        try:
+            explain_prompt = prompt_builder.build_explanation_prompt(question, sql, rows)
+            explanation = await ollama_client.explain_results(explain_prompt)
+        except Exception:
+            explanation = "Results retrieved from PostgreSQL."
 
     chart_type = prompt_builder.suggest_chart_type(columns, rows)
 
-    return JSONResponse(content={
+    return ORJSONResponse(content={
         "sql": sql,
         "columns": columns,
         "rows": rows[:100],
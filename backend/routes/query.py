@@ -3,32 +3,25 @@ POST /query  — three-way routed pipeline scoped to a file_id:
   SQL     → NL → SQL → DuckDB → LLM explain
   COMPUTE → NL → computation-aware SQL → DuckDB → LLM explain
   GENERAL → LLM answers directly (no DB needed)
+POST /query/stream — same pipeline, streamed as NDJSON stage frames
 """
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, List
+from typing import Optional
+import asyncio
+import contextlib
+import orjson
 import uuid
-import json
-from pathlib import Path
+from backend.responses import ORJSONResponse
 from backend.db import duck
+from backend.db import postgres as pg_db
+from backend.db import sessions
 from backend.llm import ollama_client, prompt_builder
 
 router = APIRouter()
 
-SESSIONS_FILE = Path(__file__).parent.parent / "data" / "sessions.json"
-
-def _load_sessions() -> dict:
-    if SESSIONS_FILE.exists():
-        try:
-            return json.loads(SESSIONS_FILE.read_text())
-        except Exception:
-            pass
-    return {}
-
-def _save_sessions(sessions: dict):
-    SESSIONS_FILE.parent.mkdir(exist_ok=True)
-    SESSIONS_FILE.write_text(json.dumps(sessions, indent=2))
+QUERY_ROW_LIMIT = 1000   # most rows a query returns, whatever its own LIMIT (beyond it: "truncated")
 
 
 class QueryRequest(BaseModel):
@@ -37,46 +30,109 @@ class QueryRequest(BaseModel):
     session_id: Optional[str] = None
 
 
-@router.post("/query")
-async def run_query(req: QueryRequest):
+def _question(req: QueryRequest) -> str:
     question = req.question.strip()
     if not question:
         raise HTTPException(status_code=400, detail="Question cannot be empty.")
+    return question
+
+
+@router.post("/query")
+async def run_query(req: QueryRequest):
+    question = _question(req)
+    async with contextlib.aclosing(_pipeline(req, question)) as frames:
+        async for frame in frames:
+            stage = frame.pop("stage")
+            if stage == "error":
+                return ORJSONResponse(status_code=frame.pop("status_code"), content=frame)
+            if stage == "result":
+                return ORJSONResponse(content=frame)
+
+
+@router.post("/query/stream")
+async def stream_query(req: QueryRequest):
+    """
+    Same pipeline as /query, sent as NDJSON frames as each stage finishes:
+    route → sql → rows → token… → result (or a single error frame).
+    """
+    question = _question(req)
+
+    async def body():
+        try:
+            async with contextlib.aclosing(_pipeline(req, question, stream_tokens=True)) as frames:
+                async for frame in frames:
+                    yield orjson.dumps(frame) + b"\n"
+        except HTTPException as e:
+            yield orjson.dumps({"stage": "error", "status_code": e.status_code, "detail": e.detail}) + b"\n"
+        except Exception as e:
+            # Headers are already sent; end the stream with a frame the client understands
+            yield orjson.dumps({"stage": "error", "status_code": 500, "detail": str(e)}) + b"\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
 
+async def _pipeline(req: QueryRequest, question: str, stream_tokens: bool = False):
+    """
+    The routed question → answer pipeline as an async generator of frames
+    ({"stage": ...}). Failures before an answer exists raise HTTPException;
+    a query that can't be executed ends with an "error" frame.
+    """
     file_id = req.file_id
     schema  = duck.get_schema(file_id) if file_id else None
 
     session_id = req.session_id or str(uuid.uuid4())
-    
-    sessions_db = _load_sessions()
-    
-    if session_id not in sessions_db:
-        sessions_db[session_id] = {
-            "id": session_id,
-            "title": question[:30] + ("..." if len(question) > 30 else ""),
-            "file_id": file_id or "global",
-            "messages": []
-        }
-    
-    history_obj = sessions_db[session_id]["messages"]
-    
-    # helper for converting history_obj into prompt_builder format
-    # prompt_builder expects [{"role": "user"|"ai", "content": "..."}]
-    history = [{"role": m["role"], "content": m.get("content", m.get("explanation", ""))[:1000]} for m in history_obj]
+
+    session = await sessions.get_session(session_id)
+    if session is None:
+        session = sessions.new_session(
+            session_id,
+            title=question[:30] + ("..." if len(question) > 30 else ""),
+            file_id=file_id or "global",
+        )
+
+    # Already in prompt_builder format ([{"role": "user"|"ai", "content": "..."}])
+    # and bounded, so prompt size doesn't grow with the chat
+    history = session["llm_history"]
 
     # ── Step 1: Classify ─────────────────────────────────────────────────
-    schema_cols = [c["name"] for c in schema["columns"]] if schema else []
+    schema_cols = duck.get_schema_cols(file_id) if schema else ()
     classify_prompt = prompt_builder.build_classify_prompt(
         question,
         schema_available=schema is not None,
         schema_columns=schema_cols,
         history=history,
     )
+    route_task = asyncio.create_task(ollama_client.classify_question(classify_prompt))
+
+    # Most questions route to SQL, so start generating that SQL while the
+    # classifier runs; it is dropped if the route turns out different
+    spec_sql_task = None
+    if schema is not None:
+        try:
+            # Sample rows only matter for the SQL prompts (loaded once per file, on demand)
+            schema = {
+                **schema,
+                "sample": await asyncio.to_thread(duck.get_sample, file_id),
+                "fingerprint": duck.get_schema_fingerprint(file_id),
+            }
+            spec_prompt = await asyncio.to_thread(prompt_builder.build_sql_prompt, question, schema, history)
+        except BaseException:
+            route_task.cancel()  # don't leave the classifier running detached
+            raise
+        spec_sql_task = asyncio.create_task(ollama_client.generate_sql(spec_prompt))
+
     try:
-        route = await ollama_client.classify_question(classify_prompt)
+        route = await route_task
     except Exception:
         route = "SQL"
 
+    if spec_sql_task is not None and route != "SQL":
+        spec_sql_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await spec_sql_task
+
+    yield {"stage": "route", "route": route.lower(), "session_id": session_id}
+
     # ── GENERAL route ─────────────────────────────────────────────────────
     if route == "GENERAL":
         gen_prompt = prompt_builder.build_general_answer_prompt(question, schema, history)
@@ -85,17 +141,18 @@ async def run_query(req: QueryRequest):
         except Exception as e:
             raise HTTPException(status_code=502, detail=f"LLM error: {e}")
             
-        sessions_db[session_id]["messages"].append({"role": "user", "content": question})
-        
         result_payload = {
-            "sql": None, "columns": [], "rows": [], "row_count": 0,
+            "sql": None, "columns": [], "rows": [], "row_count": 0, "truncated": False,
             "explanation": answer, "chart_type": "none",
             "source": "llm", "route": "general", "session_id": session_id,
         }
-        sessions_db[session_id]["messages"].append({"role": "ai", "result": result_payload})
-        _save_sessions(sessions_db)
-        
-        return JSONResponse(content=result_payload)
+        await sessions.append_messages(session, [
+            {"role": "user", "content": question},
+            {"role": "ai", "result": result_payload},
+        ])
+
+        yield {"stage": "result", **result_payload}
+        return
 
     # ── SQL / COMPUTE need a loaded file ─────────────────────────────────
     if schema is None:
@@ -105,23 +162,27 @@ async def run_query(req: QueryRequest):
         )
 
     # ── Step 2: Generate SQL ──────────────────────────────────────────────
-    sql_prompt = (
-        prompt_builder.build_compute_sql_prompt(question, schema, history)
-        if route == "COMPUTE"
-        else prompt_builder.build_sql_prompt(question, schema, history)
-    )
     try:
-        sql = await ollama_client.generate_sql(sql_prompt)
+        if route == "SQL":
+            sql = await spec_sql_task
+        else:
+            # Prompt rendering is CPU work that grows with the schema; keep it off the loop
+            sql_prompt = await asyncio.to_thread(
+                prompt_builder.build_compute_sql_prompt, question, schema, history
+            )
+            sql = await ollama_client.generate_sql(sql_prompt)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"LLM error (SQL gen): {e}")
 
     if not sql:
         raise HTTPException(status_code=500, detail="LLM returned an empty SQL query.")
 
+    yield {"stage": "sql", "sql": sql}
+
     # ── Step 3: Execute (with 1 auto-retry) ──────────────────────────────
-    rows, columns, exec_error = None, None, None
+    tbl, exec_error = None, None
     try:
-        rows, columns = duck.execute_query(sql, file_id)
+        tbl = await asyncio.to_thread(duck.execute_query, sql, file_id, QUERY_ROW_LIMIT + 1)
     except Exception as e:
         exec_error = str(e)
 
@@ -130,66 +191,90 @@ async def run_query(req: QueryRequest):
             retry_prompt = prompt_builder.build_retry_sql_prompt(question, schema, sql, exec_error)
             sql_retry = await ollama_client.generate_sql(retry_prompt)
             if sql_retry:
-                rows, columns = duck.execute_query(sql_retry, file_id)
+                tbl = await asyncio.to_thread(duck.execute_query, sql_retry, file_id, QUERY_ROW_LIMIT + 1)
                 sql = sql_retry
                 exec_error = None
         except Exception as e2:
             exec_error = f"Retry also failed: {e2}"
 
     if exec_error:
-        return JSONResponse(status_code=422, content={
+        yield {
+            "stage": "error", "status_code": 422,
             "error": exec_error, "sql": sql, "rows": [], "columns": [],
             "explanation": "I couldn't run that query. Try rephrasing — mention the exact column name.",
             "chart_type": "none", "source": "duckdb", "route": route.lower(),
             "session_id": session_id,
-        })
+        }
+        return
+
+    # Only the rows that are sent back get converted to Python objects
+    columns = tbl.column_names
+    # One row past the cap is fetched only to tell a capped result from one
+    # that happens to have exactly QUERY_ROW_LIMIT rows
+    truncated = tbl.num_rows > QUERY_ROW_LIMIT
+    if truncated:
+        tbl = tbl.slice(0, QUERY_ROW_LIMIT)
+    row_count = tbl.num_rows
+    rows = duck.arrow_to_rows(tbl.slice(0, 100))
+    chart_type = prompt_builder.suggest_chart_type(columns, rows)
+
+    yield {
+        "stage": "rows", "sql": sql, "columns": columns, "rows": rows,
+        "row_count": row_count, "truncated": truncated, "chart_type": chart_type,
+    }
 
     # ── Step 4: Explain ───────────────────────────────────────────────────
+    # The LLM sees both ends of the result (and its size), not just the top
+    explain_rows = rows
+    if row_count > len(rows):
+        explain_rows = rows[:prompt_builder.EXPLAIN_HEAD_ROWS] + duck.arrow_to_rows(
+            tbl.slice(row_count - prompt_builder.EXPLAIN_TAIL_ROWS)
+        )
+    explain_prompt = prompt_builder.build_explanation_prompt(
+        question, sql, explain_rows, total=row_count, truncated=truncated
+    )
     try:
-        explain_prompt = prompt_builder.build_explanation_prompt(question, sql, rows)
-        explanation = await ollama_client.explain_results(explain_prompt)
+        if stream_tokens:
+            pieces = []
+            async with contextlib.aclosing(ollama_client.stream_explanation(explain_prompt)) as tokens:
+                async for piece in tokens:
+                    pieces.append(piece)
+                    yield {"stage": "token", "text": piece}
+            explanation = "".join(pieces).strip()
+        else:
+            explanation = await ollama_client.explain_results(explain_prompt)
     except Exception:
         explanation = "Here are the results from your data."
 
-    chart_type = prompt_builder.suggest_chart_type(columns, rows)
-    
-    sessions_db[session_id]["messages"].append({"role": "user", "content": question})
-    
     result_payload = {
-        "sql": sql, "columns": columns, "rows": rows[:100],
-        "row_count": len(rows), "explanation": explanation,
+        "sql": sql, "columns": columns, "rows": rows,
+        "row_count": row_count, "truncated": truncated, "explanation": explanation,
         "chart_type": chart_type, "source": "duckdb", "route": route.lower(),
         "session_id": session_id,
     }
-    
-    sessions_db[session_id]["messages"].append({"role": "ai", "result": result_payload})
-    _save_sessions(sessions_db)
 
-    return JSONResponse(content=result_payload)
+    await sessions.append_messages(session, [
+        {"role": "user", "content": question},
+        {"role": "ai", "result": result_payload},
+    ])
+
+    yield {"stage": "result", **result_payload}
 
 
 @router.get("/sessions")
 async def get_sessions(file_id: Optional[str] = None):
-    sessions = _load_sessions()
-    result = list(sessions.values())
-    if file_id:
-        result = [s for s in result if s.get("file_id") == file_id]
-    return JSONResponse(content=result)
+    return ORJSONResponse(content=await sessions.list_sessions(file_id))
 
 
 @router.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
-    sessions = _load_sessions()
-    if session_id in sessions:
-        del sessions[session_id]
-        _save_sessions(sessions)
+    if await sessions.delete_session(session_id):
         return {"message": "session deleted"}
     raise HTTPException(status_code=404, detail="session not found")
 
 
 @router.get("/health")
 async def health():
-    from backend.db import postgres as pg_db
     ollama_ok = await ollama_client.check_ollama_health()
     pg_ok     = await pg_db.check_connection()
     files     = duck.list_files()
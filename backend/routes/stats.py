@@ -1,12 +1,16 @@
 """
 GET /stats?file_id= — aggregate stats from a DuckDB table scoped to a file.
 """
+import asyncio
 from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import JSONResponse
+from backend.responses import ORJSONResponse
 from backend.db import duck
 
 router = APIRouter()
 
+NUMERIC_TYPES = ("INT", "FLOAT", "DOUBLE", "DECIMAL", "NUMERIC", "HUGEINT")
+TEXT_TYPES = ("VARCHAR", "TEXT", "STRING", "CHAR", "ENUM")
+
 
 @router.get("/stats")
 async def get_stats(file_id: str = Query(..., description="UUID of the uploaded file")):
@@ -14,7 +18,6 @@ async def get_stats(file_id: str = Query(..., description="UUID of the uploaded
     if schema is None:
         raise HTTPException(status_code=404, detail=f"No dataset for file_id '{file_id}'.")
 
-    conn = duck._registry[file_id]["conn"]
     table = schema["table_name"]
 
     stats = {
@@ -26,45 +29,65 @@ async def get_stats(file_id: str = Query(..., description="UUID of the uploaded
         "columns":      schema["columns"],
     }
 
-    # Numeric column summaries
     numeric_cols = [
         c["name"] for c in schema["columns"]
-        if any(t in c["type"].upper() for t in ("INT", "FLOAT", "DOUBLE", "DECIMAL", "NUMERIC", "HUGEINT"))
+        if any(t in c["type"].upper() for t in NUMERIC_TYPES)
     ]
+    categorical_cols = [
+        c["name"] for c in schema["columns"]
+        if any(t in c["type"].upper() for t in TEXT_TYPES)
+        and c["name"] not in numeric_cols
+    ]
+
+    # DuckDB calls block, so both queries run on worker threads — at the
+    # same time, each on its own cursor
+    stats["numeric_stats"], stats["categorical_stats"] = await asyncio.gather(
+        asyncio.to_thread(_numeric_stats, file_id, table, numeric_cols[:6]),
+        asyncio.to_thread(_categorical_stats, file_id, table, categorical_cols[:4]),
+    )
+    return ORJSONResponse(content=stats)
+
 
+def _numeric_stats(file_id: str, table: str, cols: list[str]) -> dict:
+    """MIN/MAX/AVG for every numeric column in one scan."""
     numeric_stats = {}
-    for col in numeric_cols[:6]:
-        try:
-            row = conn.execute(
-                f'SELECT MIN("{col}"), MAX("{col}"), AVG("{col}") FROM "{table}"'
-            ).fetchone()
+    if not cols:
+        return numeric_stats
+    select_list = ", ".join(
+        f'MIN("{c}"), MAX("{c}"), AVG("{c}")' for c in cols
+    )
+    try:
+        with duck.cursor(file_id) as conn:
+            row = conn.execute(f'SELECT {select_list} FROM "{table}"').fetchone()
+        for i, col in enumerate(cols):
+            lo, hi, avg = row[3 * i:3 * i + 3]
             numeric_stats[col] = {
-                "min": round(row[0], 2) if row[0] is not None else None,
-                "max": round(row[1], 2) if row[1] is not None else None,
-                "avg": round(row[2], 2) if row[2] is not None else None,
+                "min": round(lo, 2) if lo is not None else None,
+                "max": round(hi, 2) if hi is not None else None,
+                "avg": round(avg, 2) if avg is not None else None,
             }
-        except Exception:
-            pass
+    except Exception:
+        pass
+    return numeric_stats
 
-    stats["numeric_stats"] = numeric_stats
-
-    # Categorical value counts (top 5 per col, first 4 cols)
-    categorical_cols = [
-        c["name"] for c in schema["columns"]
-        if any(t in c["type"].upper() for t in ("VARCHAR", "TEXT", "STRING", "CHAR"))
-        and c["name"] not in numeric_cols
-    ]
 
+def _categorical_stats(file_id: str, table: str, cols: list[str]) -> dict:
+    """Top 5 values per column, as one UNION ALL statement with each branch tagged by column index."""
     categorical_stats = {}
-    for col in categorical_cols[:4]:
-        try:
-            rows = conn.execute(
-                f'SELECT "{col}", COUNT(*) as cnt FROM "{table}" '
-                f'GROUP BY "{col}" ORDER BY cnt DESC LIMIT 5'
-            ).fetchall()
-            categorical_stats[col] = [{"value": r[0], "count": r[1]} for r in rows]
-        except Exception:
-            pass
-
-    stats["categorical_stats"] = categorical_stats
-    return JSONResponse(content=stats)
+    if not cols:
+        return categorical_stats
+    branches = " UNION ALL ".join(
+        f'(SELECT {i} AS i, CAST("{col}" AS VARCHAR) AS v, COUNT(*) AS cnt FROM "{table}" '
+        f'GROUP BY "{col}" ORDER BY cnt DESC LIMIT 5)'
+        for i, col in enumerate(cols)
+    )
+    try:
+        with duck.cursor(file_id) as conn:
+            rows = conn.execute(f"{branches} ORDER BY i, cnt DESC").fetchall()
+        for i, value, cnt in rows:
+            categorical_stats.setdefault(cols[i], []).append(
+                {"value": value, "count": cnt}
+            )
+    except Exception:
+        pass
+    return categorical_stats
@@ -2,34 +2,42 @@
 POST /upload  — accept a CSV, assign a file_id, register in DuckDB
 GET  /schema  — kept for backwards compat (requires ?file_id=)
 """
-import io
+import asyncio
+import os
+import tempfile
 import uuid
-import pandas as pd
 from fastapi import APIRouter, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from backend.responses import ORJSONResponse
 from backend.db import duck
 
 router = APIRouter()
 
+UPLOAD_CHUNK = 1 << 20  # bytes copied per read while spooling an upload
+
 
 @router.post("/upload")
 async def upload_csv(file: UploadFile = File(...)):
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="Only CSV files are supported.")
 
-    contents = await file.read()
-    try:
-        df = pd.read_csv(io.BytesIO(contents))
-    except Exception as e:
-        raise HTTPException(status_code=422, detail=f"Could not parse CSV: {e}")
-
     # Generate a stable unique id for this file
     file_id = str(uuid.uuid4())
     original_name = file.filename
 
-    schema = duck.register_dataframe(df, file_id, original_name)
+    # Spool to disk chunk by chunk and let DuckDB read the file itself, so
+    # the upload is never held in memory whole (nor as a DataFrame)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp:
+        while chunk := await file.read(UPLOAD_CHUNK):
+            tmp.write(chunk)
+    try:
+        schema = await asyncio.to_thread(duck.register_csv_path, tmp.name, file_id, original_name)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Could not parse CSV: {e}")
+    finally:
+        os.unlink(tmp.name)
+    duck.record_upload(file_id, original_name, schema)
 
-    return JSONResponse(content={
+    return ORJSONResponse(content={
         "file_id": file_id,
         "message": f"Loaded {schema['row_count']} rows from '{original_name}'.",
         "schema": schema,
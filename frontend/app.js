@@ -155,7 +155,11 @@ async function loadDashboard() {
 // ── Explorer ──────────────────────────────────────────────────────────────────
 async function loadExplorer() {
     if (state.tableRows.length === 0 && state.schema) {
-        state.tableRows = state.schema.sample || [];
+        // The schema carries no rows; fetch the first few on demand
+        try {
+            const { rows } = await api.getSample(state.activeFileId, 15);
+            state.tableRows = rows || [];
+        } catch { /* file may not be loaded in memory yet */ }
         state.tableColumns = state.schema.columns?.map(c => c.name) || [];
     }
     dataTable.setData(state.tableColumns, state.tableRows);
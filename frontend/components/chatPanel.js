@@ -224,7 +224,7 @@ export class ChatPanel {
 
     // We categorize columns roughly based on type
     const numericCols = columns.filter(c => c.type.includes('INT') || c.type.includes('DOUBLE') || c.type.includes('FLOAT') || c.type.includes('DECIMAL')).map(c => c.name);
-    const textCols = columns.filter(c => c.type.includes('VARCHAR') || c.type.includes('STRING')).map(c => c.name);
+    const textCols = columns.filter(c => c.type.includes('VARCHAR') || c.type.includes('STRING') || c.type.includes('ENUM')).map(c => c.name);
 
     let generated = [
       `How many rows are in this dataset?`
@@ -0,0 +1,42 @@
+import unittest
+
+from backend.llm.ollama_client import _clean_sql, _sql_complete
+
+
+def _stop_point(reply: str) -> str:
+    """The text a streamed generation holds when _sql_complete stops it."""
+    for i in range(1, len(reply) + 1):
+        if _sql_complete(reply[:i]):
+            return reply[:i]
+    return reply
+
+
+class SqlCompleteTest(unittest.TestCase):
+    def assertSameAsFullReply(self, reply: str):
+        self.assertEqual(_clean_sql(_stop_point(reply)), _clean_sql(reply))
+
+    def test_prose_with_keyword_before_fence(self):
+        reply = "Here is the query with a filter:\n```sql\nSELECT gender FROM uploaded;\n```"
+        self.assertEqual(_clean_sql(_stop_point(reply)), "SELECT gender FROM uploaded")
+        self.assertSameAsFullReply(reply)
+
+    def test_stops_at_closing_fence(self):
+        reply = "```sql\nSELECT churn, COUNT(*) FROM uploaded GROUP BY churn\n```\nThis counts rows per churn value."
+        self.assertTrue(_stop_point(reply).endswith("```") and _stop_point(reply).count("```") == 2)
+        self.assertSameAsFullReply(reply)
+
+    def test_semicolon_inside_open_fence_does_not_stop(self):
+        self.assertFalse(_sql_complete("```sql\nSELECT 1;"))
+
+    def test_bare_sql_stops_at_semicolon(self):
+        reply = "SELECT gender FROM uploaded; -- then some chatter"
+        self.assertEqual(_stop_point(reply), "SELECT gender FROM uploaded;")
+        self.assertSameAsFullReply(reply)
+
+    def test_bare_sql_stops_at_prose_line(self):
+        reply = "SELECT gender\nFROM uploaded\nThis lists every gender.\nMore text"
+        self.assertSameAsFullReply(reply)
+
+
+if __name__ == "__main__":
+    unittest.main()